@@ -0,0 +1,421 @@
+import logging
+import os
+import threading
+import time
+from datetime import date, timedelta
+
+import numpy as np
+import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+# Local, columnar copies of the per-project dbt tables. Each table is held as
+# a names x dates matrix per metric, so "all grantees except these" is a mask
+# over the name axis and a sum, instead of a warehouse query per exclude set.
+
+
+# Refreshes read Arrow results straight into NumPy columns rather than
+# building a dict per row; these helpers normalize the warehouse types.
+
+
+def name_column(table):
+  return table.column('NAME').to_numpy(zero_copy_only=False).astype(object)
+
+
+def day_column(table):
+  # (datetime64[D] values, date kind) for a DATE, TIMESTAMP or string column
+  column = table.column('DATE')
+  if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+    days = [value[:10] for value in column.to_pylist()]
+    return np.array(days, dtype='datetime64[D]'), 'str'
+  return column.to_numpy().astype('datetime64[D]'), 'date'
+
+
+def number_column(table, name, dtype=float):
+  column = table.column(name)
+  if pa.types.is_decimal(column.type):
+    column = column.cast(pa.float64())
+  return column.fill_null(0).to_numpy().astype(dtype)
+
+
+# the date parts the per-project tables come in; a Source's {time}
+# placeholder only ever takes one of these
+TIMEFRAMES = ['day', 'week', 'month']
+
+
+def period_start(timeframe, today=None):
+  # mirrors Snowflake's DATE_TRUNC('{time}', CURRENT_DATE()) with weeks
+  # starting on Monday
+  today = today or date.today()
+  if timeframe == 'week':
+    return today - timedelta(days=today.weekday())
+  if timeframe == 'month':
+    return today.replace(day=1)
+  return today
+
+
+class AggregateFrame:
+
+  def __init__(self, names, dates, values, present, date_kind='date'):
+    self.names = names
+    self.dates = dates
+    self.values = values
+    self.present = present
+    # the warehouse returns some DATE columns as strings; keep whatever the
+    # table gave us so responses serialize the same way
+    self.date_kind = date_kind
+
+  @classmethod
+  def from_arrow(cls, table, metrics):
+    if table is None or table.num_rows == 0:
+      return cls(np.array([], dtype=object),
+                 np.array([], dtype='datetime64[D]'),
+                 {metric: np.zeros((0, 0)) for metric in metrics},
+                 np.zeros((0, 0), dtype=bool))
+    names, name_idx = np.unique(name_column(table), return_inverse=True)
+    days, date_kind = day_column(table)
+    dates, date_idx = np.unique(days, return_inverse=True)
+
+    present = np.zeros((len(names), len(dates)), dtype=bool)
+    present[name_idx, date_idx] = True
+    values = {}
+    for metric in metrics:
+      matrix = np.zeros((len(names), len(dates)))
+      matrix[name_idx, date_idx] = number_column(table, metric)
+      values[metric] = matrix
+    return cls(names, dates, values, present, date_kind)
+
+  def merge(self, newer, since):
+    # newer replaces everything from `since` onwards, since the latest
+    # period is still being revised by the pipeline
+    keep = self.dates < np.datetime64(since, 'D')
+    names = np.array(sorted(set(self.names) | set(newer.names)), dtype=object)
+    dates = np.concatenate([self.dates[keep], newer.dates])
+
+    old_rows = np.searchsorted(names, self.names)
+    new_rows = np.searchsorted(names, newer.names)
+    split = int(keep.sum())
+
+    present = np.zeros((len(names), len(dates)), dtype=bool)
+    present[old_rows, :split] = self.present[:, keep]
+    present[new_rows, split:] = newer.present
+    values = {}
+    for metric, matrix in self.values.items():
+      merged = np.zeros((len(names), len(dates)))
+      merged[old_rows, :split] = matrix[:, keep]
+      merged[new_rows, split:] = newer.values[metric]
+      values[metric] = merged
+    return AggregateFrame(names, dates, values, present, self.date_kind)
+
+  def save(self, path):
+    arrays = {"metric_" + metric: matrix for metric, matrix in self.values.items()}
+    # unique per writer: a cold load and a background refresh can save the
+    # same frame at once
+    tmp = '%s.%d.%d.tmp.npz' % (path, os.getpid(), threading.get_ident())
+    np.savez(tmp,
+             names=self.names.astype(str),
+             dates=self.dates,
+             present=self.present,
+             date_kind=np.array(self.date_kind),
+             **arrays)
+    os.replace(tmp, path)
+
+  @classmethod
+  def load(cls, path):
+    with np.load(path) as data:
+      values = {
+        key[len("metric_"):]: data[key]
+        for key in data.files if key.startswith("metric_")
+      }
+      return cls(data["names"].astype(object), data["dates"], values,
+                 data["present"], str(data["date_kind"]))
+
+  def last_date(self):
+    return self.dates[-1].astype(date) if len(self.dates) else None
+
+  def _date_value(self, day):
+    value = day.astype(date)
+    return value.isoformat() if self.date_kind == 'str' else value
+
+  def _included(self, excludes):
+    return ~np.isin(self.names, list(excludes))
+
+  def series(self, metrics, excludes=(), start=None, end=None, casts=None):
+    # per-date sums over every project not excluded; like GROUP BY DATE, a
+    # date only appears if at least one included project has a row for it
+    casts = casts or {}
+    included = self._included(excludes)
+    columns = np.ones(len(self.dates), dtype=bool)
+    if start is not None:
+      columns &= self.dates >= np.datetime64(start, 'D')
+    if end is not None:
+      columns &= self.dates < np.datetime64(end, 'D')
+    columns &= self.present[included].any(axis=0)
+
+    totals = {
+      metric: self.values[metric][included][:, columns].sum(axis=0)
+      for metric in metrics
+    }
+    rows = []
+    for i, day in enumerate(self.dates[columns]):
+      row = {"DATE": self._date_value(day)}
+      for metric in metrics:
+        row[metric] = casts.get(metric, float)(totals[metric][i])
+      rows.append(row)
+    return rows
+
+  def total(self, metric, excludes=(), start=None, end=None):
+    columns = np.ones(len(self.dates), dtype=bool)
+    if start is not None:
+      columns &= self.dates >= np.datetime64(start, 'D')
+    if end is not None:
+      columns &= self.dates < np.datetime64(end, 'D')
+    included = self._included(excludes)
+    return float(self.values[metric][included][:, columns].sum())
+
+  def snapshot(self, metric, day, excludes=()):
+    # (names, values) of the included projects with a row on `day`
+    column = np.searchsorted(self.dates, np.datetime64(day, 'D'))
+    if column >= len(self.dates) or self.dates[column] != np.datetime64(
+        day, 'D'):
+      return self.names[:0], np.zeros(0)
+    rows = self._included(excludes) & self.present[:, column]
+    return self.names[rows], self.values[metric][rows, column]
+
+
+class SortedSeries:
+  # an Arrow result ordered by DATE, so any window of the series is a
+  # binary search over one fetch and a zero-copy slice of it
+
+  def __init__(self, table):
+    self.table = table
+    self.dates = day_column(table)[0] if table.num_rows else np.array(
+      [], dtype='datetime64[D]')
+
+  def since(self, start, drop=()):
+    # rows from start on, as a DictCursor returns them, less the drop columns
+    if not self.table.num_rows:
+      return []
+    offset = np.searchsorted(self.dates, np.datetime64(start, 'D'))
+    return self.table.slice(int(offset)).drop_columns(list(drop)).to_pylist()
+
+
+def top_share(names, values, metric, pct_column, top=5, cast=float):
+  # same shape as the RANK() <= 5 / 'Other' pie queries: ties share a rank,
+  # percentages are rounded to two places and rows are sorted by value
+  if not len(values):
+    return []
+  total = values.sum()
+  ranks = np.searchsorted(np.sort(-values), -values, side='left') + 1
+  rows = [{
+    "NAME": name,
+    metric: cast(value),
+    pct_column: round(float(value / total * 100), 2) if total else None
+  } for name, value, rank in zip(names, values, ranks) if rank <= top]
+  other = values[ranks > top]
+  if len(other):
+    rows.append({
+      "NAME": "Other",
+      metric: cast(other.sum()),
+      pct_column: round(float(other.sum() / total * 100), 2) if total else None
+    })
+  rows.sort(key=lambda row: row[metric], reverse=True)
+  return rows
+
+
+class Source:
+  # a SELECT returning NAME, DATE and the metric columns, with {time} and
+  # {since} placeholders; the first load starts history_days back, or at the
+  # beginning of the table when that is None
+
+  def __init__(self, sql, metrics, frame_type=AggregateFrame,
+               history_days=None):
+    self.sql = sql
+    self.metrics = metrics
+    self.frame_type = frame_type
+    self.history_days = history_days
+
+  @classmethod
+  def table(cls, table, metrics):
+    sql = "SELECT NAME, DATE, %s FROM ARBIGRANTS.DBT.%s WHERE DATE >= '{since}'"
+    return cls(sql % (', '.join(metrics), table), metrics)
+
+  def statement(self, timeframe, since=None):
+    # {time} names a table or a date part, so it is spliced into the text
+    if timeframe not in TIMEFRAMES:
+      raise ValueError('unknown timeframe: %s' % timeframe)
+    if since is None and self.history_days:
+      since = date.today() - timedelta(days=self.history_days)
+    since = since or date(1970, 1, 1)
+    return self.sql.format(time=timeframe, since=since.isoformat())
+
+
+class AggregateStore:
+  # sources maps a store name to its Source and query returns a statement's
+  # result as an Arrow table. Frames are loaded from
+  # `directory` when present and refreshed incrementally in the background
+  # once they are older than refresh_interval. changed_at, when given,
+  # returns the time the source data last changed; a frame built before it
+  # is refreshed before it is used. ready() lets callers that can't wait for
+  # a warehouse fetch start it in the background and answer another way.
+  # Refreshes only re-read the rows from a frame's last date on, so once
+  # rebuild_interval has passed since a frame was last read in full, the
+  # next refresh reads it in full again and picks up rewritten history.
+
+  def __init__(self,
+               query,
+               sources,
+               directory,
+               refresh_interval,
+               changed_at=None,
+               rebuild_interval=None):
+    self._query = query
+    self.sources = sources
+    self.directory = directory
+    self.refresh_interval = refresh_interval
+    self._changed_at = changed_at
+    self.rebuild_interval = rebuild_interval
+    self._frames = {}
+    self._loaded_at = {}
+    self._rebuilt_at = {}
+    self._refreshing = set()
+    self._lock = threading.Lock()
+    self._key_locks = {}
+
+  def _path(self, name, timeframe):
+    return os.path.join(self.directory, '%s_%s.npz' % (name, timeframe))
+
+  def _rebuilt_path(self, name, timeframe):
+    # its mtime is when the frame was last read in full
+    return self._path(name, timeframe) + '.rebuilt'
+
+  def _rebuild_due(self, name, timeframe):
+    if not self.rebuild_interval:
+      return False
+    key = (name, timeframe)
+    with self._lock:
+      rebuilt_at = self._rebuilt_at.get(key)
+    if rebuilt_at is None:
+      path = self._rebuilt_path(name, timeframe)
+      rebuilt_at = (os.path.getmtime(path)
+                    if self.directory and os.path.exists(path) else 0)
+    return time.time() - rebuilt_at > self.rebuild_interval
+
+  def _load(self, name, timeframe):
+    # (frame, mtime) from disk, or (None, 0) when there is no file
+    path = self._path(name, timeframe)
+    if not os.path.exists(path):
+      return None, 0
+    loaded_at = os.path.getmtime(path)
+    frame = self.sources[name].frame_type.load(path)
+    with self._lock:
+      self._frames[(name, timeframe)] = frame
+      self._loaded_at[(name, timeframe)] = loaded_at
+    return frame, loaded_at
+
+  def ready(self, name, timeframe):
+    # True when frame() can answer from memory or disk; otherwise the
+    # warehouse fetch it would need is started in the background
+    key = (name, timeframe)
+    with self._lock:
+      loaded_at = self._loaded_at.get(key) if key in self._frames else None
+    path = self._path(name, timeframe)
+    if self.directory and os.path.exists(path):
+      loaded_at = max(loaded_at or 0, os.path.getmtime(path))
+    changed = self._changed_at() if self._changed_at else None
+    if loaded_at is not None and (changed is None or loaded_at >= changed):
+      return True
+    self._in_background(key, lambda: self.frame(name, timeframe))
+    return False
+
+  def _key_lock(self, key):
+    with self._lock:
+      return self._key_locks.setdefault(key, threading.Lock())
+
+  def _behind(self, loaded_at):
+    changed = self._changed_at() if self._changed_at else None
+    return changed is not None and loaded_at < changed
+
+  def frame(self, name, timeframe):
+    key = (name, timeframe)
+    with self._lock:
+      frame = self._frames.get(key)
+      loaded_at = self._loaded_at.get(key, 0)
+    if frame is None or self._behind(loaded_at):
+      # one load per frame at a time; the callers queued behind it find
+      # its result
+      with self._key_lock(key):
+        return self._current(name, timeframe)
+    if time.time() - loaded_at > self.refresh_interval:
+      self._refresh_in_background(name, timeframe)
+    return frame
+
+  def _current(self, name, timeframe):
+    key = (name, timeframe)
+    with self._lock:
+      frame = self._frames.get(key)
+      loaded_at = self._loaded_at.get(key, 0)
+    if frame is None:
+      frame, loaded_at = self._load(name, timeframe)
+      if frame is None:
+        return self._fetch(name, timeframe)
+    if self._behind(loaded_at):
+      # results built from this frame would be stamped with the new data
+      # version; another process may already have written a newer file
+      path = self._path(name, timeframe)
+      if self.directory and os.path.exists(path) and (
+          not self._behind(os.path.getmtime(path))):
+        return self._load(name, timeframe)[0]
+      return self._fetch(name, timeframe)
+    return frame
+
+  def _refresh_in_background(self, name, timeframe):
+    self._in_background((name, timeframe),
+                        lambda: self.refresh(name, timeframe))
+
+  def _in_background(self, key, work):
+    with self._lock:
+      if key in self._refreshing:
+        return
+      self._refreshing.add(key)
+
+    def run():
+      try:
+        work()
+      except Exception:
+        logger.exception('refreshing aggregate %s_%s failed', *key)
+      finally:
+        with self._lock:
+          self._refreshing.discard(key)
+
+    threading.Thread(target=run, daemon=True).start()
+
+  def refresh(self, name, timeframe):
+    with self._key_lock((name, timeframe)):
+      return self._fetch(name, timeframe)
+
+  def _fetch(self, name, timeframe):
+    key = (name, timeframe)
+    source = self.sources[name]
+    with self._lock:
+      current = self._frames.get(key)
+    since = None
+    if current is not None and not self._rebuild_due(name, timeframe):
+      since = current.last_date()
+
+    table = self._query(source.statement(timeframe, since))
+    fresh = source.frame_type.from_arrow(table, source.metrics)
+    frame = current.merge(fresh, since) if since is not None else fresh
+
+    if self.directory:
+      os.makedirs(self.directory, exist_ok=True)
+      frame.save(self._path(name, timeframe))
+      if since is None:
+        with open(self._rebuilt_path(name, timeframe), 'w'):
+          pass
+    with self._lock:
+      self._frames[key] = frame
+      self._loaded_at[key] = time.time()
+      if since is None:
+        self._rebuilt_at[key] = time.time()
+    return frame
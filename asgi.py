@@ -0,0 +1,150 @@
+import asyncio
+import io
+import os
+import sys
+import time
+
+from flask import request
+from main import (CACHE_LOCK_TTL, app as flask_app, cache, cached_response,
+                  data_version, encode_payload, load_entry, lock_wait_deadline,
+                  make_cache_key, payload_response, store_entry)
+
+# ASGI entry point: `uvicorn asgi:app`. Cached routes run their coroutine
+# views on the server's event loop, so a request waiting on the warehouse
+# holds neither a thread nor a Snowflake connection and one process can keep
+# hundreds of them in flight. Blocking Redis calls and every other route go
+# through worker threads.
+
+# per-process counterpart of main.single_flight for the event loop
+inflight = {}
+
+
+def scope_environ(scope, body):
+  environ = {
+    "REQUEST_METHOD": scope["method"],
+    "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+    "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+    "QUERY_STRING": scope["query_string"].decode("latin-1"),
+    "SERVER_PROTOCOL": "HTTP/%s" % scope["http_version"],
+    "wsgi.version": (1, 0),
+    "wsgi.url_scheme": scope.get("scheme", "http"),
+    "wsgi.input": io.BytesIO(body),
+    "wsgi.errors": sys.stderr,
+    "wsgi.multithread": True,
+    "wsgi.multiprocess": True,
+    "wsgi.run_once": False,
+  }
+  server = scope.get("server") or ("localhost", 80)
+  environ["SERVER_NAME"] = server[0]
+  environ["SERVER_PORT"] = str(server[1] or 80)
+  if scope.get("client"):
+    environ["REMOTE_ADDR"] = scope["client"][0]
+  for name, value in scope.get("headers", []):
+    name = name.decode("latin-1")
+    if name == "content-length":
+      key = "CONTENT_LENGTH"
+    elif name == "content-type":
+      key = "CONTENT_TYPE"
+    else:
+      key = "HTTP_" + name.upper().replace("-", "_")
+    value = value.decode("latin-1")
+    if key in environ:
+      value = environ[key] + "," + value
+    environ[key] = value
+  return environ
+
+
+async def compute_entry(key, view):
+  # main.fill_entry without blocking the loop
+  lock_key = 'lock:' + key
+  version = await asyncio.to_thread(data_version)
+  if await asyncio.to_thread(cache.add, lock_key, os.getpid(),
+                             timeout=CACHE_LOCK_TTL):
+    try:
+      payload = await asyncio.to_thread(encode_payload, await view())
+      return await asyncio.to_thread(store_entry, key, payload, version)
+    finally:
+      await asyncio.to_thread(cache.delete, lock_key)
+
+  deadline = lock_wait_deadline()
+  while time.monotonic() < deadline:
+    await asyncio.sleep(0.25)
+    entry = await asyncio.to_thread(load_entry, key)
+    if entry is not None:
+      return entry
+  payload = await asyncio.to_thread(encode_payload, await view())
+  return await asyncio.to_thread(store_entry, key, payload, version)
+
+
+async def fill_entry(key, view):
+  task = inflight.get(key)
+  if task is None:
+    task = inflight[key] = asyncio.ensure_future(compute_entry(key, view))
+    task.add_done_callback(lambda _: inflight.pop(key, None))
+  # a disconnecting client must not cancel the computation others wait on
+  return await asyncio.shield(task)
+
+
+async def dispatch():
+  view = None
+  if request.routing_exception is None and request.method == 'GET':
+    view = getattr(flask_app.view_functions[request.endpoint], 'cached_view',
+                   None)
+  if view is None:
+    return await asyncio.to_thread(flask_app.full_dispatch_request)
+
+  try:
+    response = flask_app.preprocess_request()
+    if response is None:
+      key = make_cache_key()
+      response = await asyncio.to_thread(cached_response, key, view)
+      if response is None:
+        response = payload_response(await fill_entry(key, view), key)
+  except Exception as e:
+    response = flask_app.handle_user_exception(e)
+  return flask_app.finalize_request(response)
+
+
+async def lifespan(receive, send):
+  while True:
+    message = await receive()
+    if message["type"] == "lifespan.startup":
+      await send({"type": "lifespan.startup.complete"})
+    elif message["type"] == "lifespan.shutdown":
+      await send({"type": "lifespan.shutdown.complete"})
+      return
+
+
+async def app(scope, receive, send):
+  if scope["type"] == "lifespan":
+    return await lifespan(receive, send)
+  if scope["type"] != "http":
+    return
+
+  body = b''
+  while True:
+    message = await receive()
+    body += message.get("body", b'')
+    if not message.get("more_body"):
+      break
+
+  with flask_app.request_context(scope_environ(scope, body)):
+    try:
+      response = await dispatch()
+    except Exception as e:
+      response = flask_app.handle_exception(e)
+    data = b'' if scope["method"] == 'HEAD' else response.get_data()
+
+  headers = [(name.lower().encode("latin-1"), value.encode("latin-1"))
+             for name, value in response.headers.items()]
+  await send({
+    "type": "http.response.start",
+    "status": response.status_code,
+    "headers": headers,
+  })
+  await send({"type": "http.response.body", "body": data})
+
+
+if __name__ == '__main__':
+  import uvicorn
+  uvicorn.run(app, host='0.0.0.0', port=81)
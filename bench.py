@@ -0,0 +1,549 @@
+import asyncio
+import hashlib
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+
+import click
+
+# Load benchmark for the API against a local stand-in for Snowflake and Redis:
+#
+#   python bench.py --concurrency 32 --requests 500 --latency 0.3
+#
+# The fake warehouse answers the connector calls main.py makes (execute,
+# execute_async + polling, multi-statement nextset, Arrow fetches) with
+# synthetic rows shaped like the ARBIGRANTS tables, after a configurable
+# per-statement latency. Redis is fakeredis unless --redis points at a real
+# server. Results are reported per endpoint.
+
+NAME_COLUMNS = {'NAME'}
+TEXT_COLUMNS = {
+  'LOGO', 'DESCRIPTION', 'WEBSITE', 'TWITTER', 'DUNE', 'LLAMA_NAME',
+  'CONTRACT_ADDRESS'
+}
+INT_HINTS = ('WALLETS', 'TRANSACTIONS', 'MILESTONES', 'COUNT')
+
+# (table suffix, columns, row cap) for SELECT * from a dbt table; the first
+# matching suffix wins
+TABLE_COLUMNS = [
+  ('_SUMMARY', [
+    '%s%s_%s' % (pct, time, metric) for time in ('DAY', 'WEEK', 'MONTH')
+    for metric in ('ACTIVE_WALLETS', 'GAS_SPEND') for pct in ('', 'PCT_')
+  ] + ['TVL_GRANTEES'], 1),
+  ('_MILESTONE_SUMMARY', ['MILESTONES_COMPLETED', 'TOTAL_MILESTONES'], 1),
+  ('_TVL_BY_PROJECT', ['NAME', 'DATE', 'TVL', 'TVL_ETH'], None),
+  ('_ACTIVE_WALLETS_BY_PROJECT', ['NAME', 'DATE', 'ACTIVE_WALLETS'], None),
+  ('_GAS_SPEND_BY_PROJECT', ['NAME', 'DATE', 'GAS_SPEND'], None),
+  ('_TVL_POST_GRANT', ['DATE', 'TVL', 'TVL_ETH'], None),
+  ('_TVL_PIE', ['NAME', 'TVL', 'PCT_TVL'], 6),
+  ('_TVL', ['DATE', 'TVL', 'TVL_ETH'], None),
+  ('_ACTIVE_WALLETS_POST_GRANT', ['DATE', 'ACTIVE_WALLETS'], None),
+  ('_ACTIVE_WALLETS_ARBITRUM_ONE', ['DATE', 'ACTIVE_WALLETS'], None),
+  ('_ACTIVE_WALLETS', ['DATE', 'ACTIVE_WALLETS'], None),
+  ('_WALLETS_PIE', ['NAME', 'ACTIVE_WALLETS', 'PCT_WALLETS'], 6),
+  ('_LEADERBOARD', ['NAME', 'CATEGORY', 'WALLETS', 'GAS_SPEND'], None),
+  ('_LABELS_PROJECT_METADATA', [
+    'NAME', 'CHAIN', 'LOGO', 'DESCRIPTION', 'WEBSITE', 'TWITTER', 'DUNE',
+    'LLAMA_NAME', 'GRANT_DATE'
+  ], None),
+  ('_LABELS_PROJECT_MILESTONES',
+   ['NAME', 'MILESTONES_COMPLETED', 'TOTAL_MILESTONES'], None),
+  ('_LABELS_PROJECT_CONTRACTS', ['NAME', 'CONTRACT_ADDRESS'], None),
+]
+
+
+def top_level(sql):
+  # (index, char) of the characters outside parentheses and string literals
+  depth = 0
+  quoted = False
+  for i, char in enumerate(sql):
+    if char == "'":
+      quoted = not quoted
+    elif quoted:
+      continue
+    elif char == '(':
+      depth += 1
+    elif char == ')':
+      depth -= 1
+    elif depth == 0:
+      yield i, char
+
+
+def top_level_words(sql, word):
+  outside = set(i for i, _ in top_level(sql))
+  return [
+    match.start() for match in re.finditer(r'\b%s\b' % word, sql, re.I)
+    if match.start() in outside
+  ]
+
+
+def split_top_level(text):
+  commas = [i for i, char in top_level(text) if char == ',']
+  bounds = [-1] + commas + [len(text)]
+  return [text[a + 1:b].strip() for a, b in zip(bounds, bounds[1:])]
+
+
+def cte_body(sql, name):
+  match = re.search(r'\b%s\s+AS\s*\(' % re.escape(name), sql, re.I)
+  if match is None:
+    return None
+  depth = 0
+  for i in range(match.end() - 1, len(sql)):
+    depth += {'(': 1, ')': -1}.get(sql[i], 0)
+    if depth == 0:
+      return sql[match.end():i]
+  return None
+
+
+def result_shape(sql, whole=None):
+  # (columns, literal values by column, row cap) of the statement's final
+  # top-level SELECT, following SELECT * into CTEs and known tables
+  whole = whole or sql
+  selects = top_level_words(sql, 'SELECT')
+  if not selects:
+    return ['RESULT'], {}, 1
+  start = selects[-1] + len('SELECT')
+  froms = [i for i in top_level_words(sql, 'FROM') if i > start]
+  end = froms[0] if froms else len(sql)
+  source = sql[end + len('FROM'):] if froms else ''
+  source = re.split(r'\b(WHERE|ORDER|GROUP|UNION|LIMIT|INNER|LEFT|JOIN)\b',
+                    source, flags=re.I)[0]
+
+  columns, literals, cap = [], {}, None
+  for item in split_top_level(sql[start:end]):
+    if item == '*':
+      tables = [part.split()[0] for part in source.split(',') if part.strip()]
+      for table in tables:
+        body = cte_body(whole, table)
+        if body is not None:
+          more, more_literals, more_cap = result_shape(body, whole)
+        else:
+          more, more_literals, more_cap = ['RESULT'], {}, None
+          for suffix, table_columns, table_cap in TABLE_COLUMNS:
+            if table.upper().endswith(suffix):
+              more, more_cap = table_columns, table_cap
+              break
+        columns += more
+        literals.update(more_literals)
+        cap = more_cap or cap
+      continue
+    alias = re.search(r'\bAS\s+"?(\w+)"?\s*$', item, re.I)
+    column = (alias.group(1) if alias else re.split(r'[.\s]', item)[-1]).upper()
+    literal = re.match(r"^'([^']*)'", item)
+    if literal:
+      literals[column] = literal.group(1)
+    columns.append(column)
+  return columns, literals, cap
+
+
+class Warehouse:
+  # synthetic data: `projects` grantees with daily, weekly or monthly rows
+  # going back `history_days`; every statement takes latency +- jitter
+
+  def __init__(self, projects, history_days, latency, jitter, route=None):
+    self.names = ['project-%03d' % i for i in range(projects)]
+    self.history_days = history_days
+    self.latency = latency
+    self.jitter = jitter
+    self.route = route or (lambda: '')
+    self.version = datetime.now(timezone.utc).replace(microsecond=0)
+    self.queries = {}
+    self.calls = Counter()
+    self.statements = Counter()
+    self.lock = threading.Lock()
+
+  def delay(self):
+    return max(0.0, random.uniform(self.latency - self.jitter,
+                                   self.latency + self.jitter))
+
+  def record(self, sql, statements):
+    route = self.route()
+    with self.lock:
+      self.calls[route] += 1
+      self.statements[route] += statements
+
+  def submit(self, sql, statements):
+    self.record(sql, statements)
+    query_id = uuid.uuid4().hex
+    with self.lock:
+      self.queries[query_id] = (time.monotonic() + self.delay(), sql,
+                                statements)
+    return query_id
+
+  def running(self, query_id):
+    return time.monotonic() < self.queries[query_id][0]
+
+  def results(self, query_id):
+    with self.lock:
+      _, sql, statements = self.queries.pop(query_id)
+    return self.answer(sql, statements)
+
+  def run(self, sql, statements):
+    self.record(sql, statements)
+    time.sleep(self.delay())
+    return self.answer(sql, statements)
+
+  def answer(self, sql, statements):
+    if statements > 1:
+      return [self.rows(part) for part in sql.split(';\n')][:statements]
+    return [self.rows(sql)]
+
+  def dates(self, sql):
+    today = date.today()
+    timeframe = re.search(r"_(DAY|WEEK|MONTH)_|DATE_TRUNC\('(day|week|month)'",
+                          sql, re.I)
+    timeframe = (timeframe.group(1) or timeframe.group(2)).lower(
+    ) if timeframe else 'day'
+    start = today - timedelta(days=self.history_days)
+    literal = re.search(r"'(\d{4}-\d{2}-\d{2})", sql)
+    if literal:
+      start = max(start, date.fromisoformat(literal.group(1)))
+    if timeframe == 'month':
+      start = start.replace(day=1)
+      dates = []
+      while start < today:
+        dates.append(start)
+        start = (start + timedelta(days=32)).replace(day=1)
+      return dates
+    step = 7 if timeframe == 'week' else 1
+    if timeframe == 'week':
+      start -= timedelta(days=start.weekday())
+    return [
+      start + timedelta(days=i) for i in range(0, (today - start).days, step)
+    ]
+
+  def selected_names(self, sql):
+    # NAME IN ('a', 'b') or LOWER(NAME) IN (LOWER('a'), ...)
+    listed = re.search(
+      r"(?<!NOT )\bIN \(((?:[^()]|\([^()]*\))*'(?:[^()]|\([^()]*\))*)\)", sql)
+    if listed:
+      return re.findall(r"'([^']*)'", listed.group(1))
+    single = re.search(r"\bNAME\) = LOWER\('([^']*)'\)|\bNAME = '([^']*)'", sql)
+    if single:
+      return [single.group(1) or single.group(2)]
+    excluded = re.search(r'NOT IN \(([^)]*)\)', sql)
+    excluded = set(re.findall(r"'([^']*)'",
+                              excluded.group(1))) if excluded else ()
+    return [name for name in self.names if name not in excluded]
+
+  def rows(self, sql):
+    if sql.startswith('SHOW TABLES'):
+      return [{"name": "ARBIGRANTS_ALL_MILESTONE_SUMMARY",
+               "created_on": self.version}]
+    columns, literals, cap = result_shape(sql)
+    rng = random.Random(hashlib.sha256(sql.encode('utf-8')).digest())
+    names = self.selected_names(sql) if 'NAME' in columns else [None]
+    dates = self.dates(sql) if 'DATE' in columns else [None]
+    registers = range(8) if 'IDX' in columns else [None]
+
+    rows = []
+    for name in names:
+      for day in dates:
+        for _ in registers:
+          row = {}
+          for column in columns:
+            row[column] = self.value(column, name, day, literals, rng)
+          rows.append(row)
+          if cap and len(rows) >= cap:
+            return rows
+    return rows
+
+  def value(self, column, name, day, literals, rng):
+    if column in literals:
+      return literals[column]
+    if column in NAME_COLUMNS:
+      return name
+    if column == 'DATE':
+      return day
+    if column == 'CHAIN':
+      return 'Arbitrum One'
+    if column == 'GRANT_DATE':
+      return '2023-06-01'
+    if column in TEXT_COLUMNS:
+      return '%s-%s' % (column.lower(), name)
+    if column == 'IDX':
+      return rng.randrange(4096)
+    if column == 'RANK':
+      return rng.randrange(1, 20)
+    if column.startswith('PCT_'):
+      return round(rng.uniform(0, 100), 2)
+    if any(hint in column for hint in INT_HINTS):
+      return rng.randrange(0, 50000)
+    return rng.uniform(0, 1e7)
+
+
+def inline(sql, params):
+  # the stand-in reads names and dates from the statement text, so bound
+  # values go back in as literals
+  values = iter(params or ())
+  return re.sub(r'\?', lambda _: "'%s'" % next(values), sql)
+
+
+class FakeCursor:
+
+  def __init__(self, warehouse, as_dict):
+    self.warehouse = warehouse
+    self.as_dict = as_dict
+    self.sfqid = None
+    self._sets = [[]]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def close(self):
+    pass
+
+  def execute(self, sql, params=None, num_statements=None, **kwargs):
+    self.sfqid = uuid.uuid4().hex
+    self._sets = self.warehouse.run(inline(sql, params), num_statements or 1)
+    return self
+
+  def execute_async(self, sql, params=None, num_statements=None, **kwargs):
+    self.sfqid = self.warehouse.submit(inline(sql, params), num_statements
+                                       or 1)
+    return {"queryId": self.sfqid}
+
+  def get_results_from_sfqid(self, query_id):
+    self.sfqid = query_id
+    self._sets = self.warehouse.results(query_id)
+
+  def nextset(self):
+    if len(self._sets) <= 1:
+      return None
+    self._sets = self._sets[1:]
+    return self
+
+  def fetchall(self):
+    rows = self._sets[0]
+    return rows if self.as_dict else [tuple(row.values()) for row in rows]
+
+  def fetch_arrow_all(self):
+    import pyarrow as pa
+    return pa.Table.from_pylist(self._sets[0]) if self._sets[0] else None
+
+
+class FakeConnection:
+
+  def __init__(self, warehouse):
+    self.warehouse = warehouse
+    self._closed = False
+
+  def cursor(self, cursor_class=None):
+    return FakeCursor(self.warehouse, cursor_class is not None)
+
+  def is_closed(self):
+    return self._closed
+
+  def close(self):
+    self._closed = True
+
+  def get_query_status_throw_if_error(self, query_id):
+    return self.warehouse.running(query_id)
+
+  @staticmethod
+  def is_still_running(status):
+    return status
+
+
+# the stores' scratch directories for this run
+TEMP_DIRS = []
+
+
+def load_app(warehouse, redis_url, cold):
+  # main reads its settings at import time, so the stand-ins go in first
+  os.environ.setdefault('SNOWFLAKE_USER', 'bench')
+  os.environ.setdefault('SNOWFLAKE_PASS', 'bench')
+  os.environ.setdefault('SNOWFLAKE_ACCOUNT', 'bench')
+  os.environ.setdefault('SNOWFLAKE_WAREHOUSE', 'bench')
+  # removed when the run exits
+  for name, prefix in (('AGGREGATE_DIR', 'bench-aggregates-'),
+                       ('REPLICA_DIR', 'bench-replica-')):
+    directory = tempfile.TemporaryDirectory(prefix=prefix)
+    TEMP_DIRS.append(directory)
+    os.environ[name] = directory.name
+  if cold:
+    os.environ['FRAGMENT_CACHE_TTL'] = '0'
+    os.environ['L1_CACHE_BYTES'] = '0'
+  if redis_url:
+    os.environ['REDIS'] = redis_url
+  else:
+    import fakeredis
+    import redis
+    server = fakeredis.FakeServer()
+    os.environ['REDIS'] = 'redis://fakeredis'
+    redis.from_url = lambda *args, **kwargs: fakeredis.FakeStrictRedis(
+      server=server)
+    redis.Redis.from_url = classmethod(
+      lambda cls, *args, **kwargs: fakeredis.FakeStrictRedis(server=server))
+
+  import snowflake.connector
+  snowflake.connector.connect = lambda **kwargs: FakeConnection(warehouse)
+
+  import main
+  warehouse.route = main.current_route
+  if cold:
+    # every request gets its own cache key, so nothing is served from cache
+    canonical_cache_key = main.canonical_cache_key
+    main.canonical_cache_key = lambda path, params: '%s:%s' % (
+      canonical_cache_key(path, params), uuid.uuid4().hex)
+  return main
+
+
+def endpoints(names):
+  # endpoint -> function returning (path, params) for one request
+  return {
+    '/overview':
+    lambda rng: ('/overview', {
+      'timeframe': rng.choice(['day', 'week', 'month']),
+      'timescale': rng.choice(['3', '6', '12']),
+      'chain': rng.choice(['all', 'one']),
+    }),
+    '/overview?excludes':
+    lambda rng: ('/overview', {
+      'timeframe': rng.choice(['day', 'week', 'month']),
+      'timescale': rng.choice(['3', '6', '12']),
+      'excludes': rng.sample(names, rng.randint(1, 3)),
+    }),
+    '/grantee':
+    lambda rng: ('/grantee', {
+      'timeframe': rng.choice(['day', 'week', 'month']),
+      'grantee_name': rng.choice(names),
+    }),
+    '/grantee-public':
+    lambda rng: ('/grantee-public', {
+      'grantee_name': rng.choice(names)
+    }),
+  }
+
+
+def percentile(values, pct):
+  values = sorted(values)
+  if not values:
+    return 0.0
+  return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+async def drive_asgi(app, targets, concurrency):
+  import httpx
+  limit = asyncio.Semaphore(concurrency)
+  timings = []
+  errors = Counter()
+  transport = httpx.ASGITransport(app=app)
+  async with httpx.AsyncClient(transport=transport,
+                               base_url='http://bench',
+                               timeout=None) as client:
+
+    async def one(path, params):
+      async with limit:
+        start = time.perf_counter()
+        response = await client.get(path, params=params)
+        timings.append(time.perf_counter() - start)
+        if response.status_code != 200:
+          errors[response.status_code] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(path, params) for path, params in targets))
+  return time.perf_counter() - start, timings, errors
+
+
+def drive_wsgi(app, targets, concurrency):
+  timings = []
+  errors = Counter()
+  local = threading.local()
+
+  def one(target):
+    path, params = target
+    client = getattr(local, 'client', None)
+    if client is None:
+      client = local.client = app.test_client()
+    start = time.perf_counter()
+    response = client.get(path, query_string=params)
+    timings.append(time.perf_counter() - start)
+    if response.status_code != 200:
+      errors[response.status_code] += 1
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    list(executor.map(one, targets))
+  return time.perf_counter() - start, timings, errors
+
+
+@click.command()
+@click.option('--server',
+              type=click.Choice(['asgi', 'wsgi']),
+              default='asgi',
+              help='Drive asgi.app on one event loop, or main.app from a '
+              'thread per concurrent request.')
+@click.option('--endpoint',
+              'selected',
+              multiple=True,
+              help='Only benchmark these endpoints (repeatable).')
+@click.option('--concurrency', default=16, help='Requests in flight.')
+@click.option('--requests', 'count', default=200,
+              help='Measured requests per endpoint.')
+@click.option('--warmup', default=20,
+              help='Unmeasured requests per endpoint first.')
+@click.option('--latency', default=0.2, help='Seconds per statement.')
+@click.option('--jitter', default=0.05, help='+- seconds per statement.')
+@click.option('--projects', default=60, help='Synthetic grantees.')
+@click.option('--history-days', default=400, help='Synthetic history.')
+@click.option('--cold',
+              is_flag=True,
+              help='Bypass the route and fragment caches.')
+@click.option('--redis', 'redis_url', default=None,
+              help='Use this Redis instead of fakeredis.')
+@click.option('--seed', default=0, help='Seed for the request mix.')
+@click.option('--output', default=None, help='Also write the report here.')
+def bench(server, selected, concurrency, count, warmup, latency, jitter,
+          projects, history_days, cold, redis_url, seed, output):
+  warehouse = Warehouse(projects, history_days, latency, jitter)
+  main = load_app(warehouse, redis_url, cold)
+  if server == 'asgi':
+    import asgi
+    run = lambda targets: asyncio.run(
+      drive_asgi(asgi.app, targets, concurrency))
+  else:
+    run = lambda targets: drive_wsgi(main.app, targets, concurrency)
+
+  rng = random.Random(seed)
+  lines = [
+    '%s server, concurrency %d, %d requests per endpoint, %.2fs +- %.2fs '
+    'per statement%s' % (server, concurrency, count, latency, jitter,
+                         ', cold caches' if cold else ''),
+    '%-20s %8s %9s %9s %9s %9s %9s %6s' % ('endpoint', 'req/s', 'p50 ms',
+                                           'p95 ms', 'p99 ms', 'calls/req',
+                                           'stmts/req', 'errors'),
+  ]
+  for name, target in endpoints(warehouse.names).items():
+    if selected and name not in selected:
+      continue
+    run([target(rng) for _ in range(warmup)])
+    route = name.split('?')[0]
+    calls, statements = warehouse.calls[route], warehouse.statements[route]
+    elapsed, timings, errors = run([target(rng) for _ in range(count)])
+    lines.append('%-20s %8.1f %9.1f %9.1f %9.1f %9.2f %9.2f %6d' % (
+      name, count / elapsed, percentile(timings, 50) * 1000,
+      percentile(timings, 95) * 1000, percentile(timings, 99) * 1000,
+      (warehouse.calls[route] - calls) / count,
+      (warehouse.statements[route] - statements) / count,
+      sum(errors.values())))
+
+  report = '\n'.join(lines)
+  click.echo(report)
+  if output:
+    with open(output, 'w') as f:
+      f.write(report + '\n')
+
+
+if __name__ == '__main__':
+  bench()
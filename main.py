@@ -1,13 +1,40 @@
-from flask import Flask, jsonify, request
+from flask import Flask, abort, g, has_request_context, request
 from flask_cors import CORS
 from flask_caching import Cache
-from httpx import Timeout
 import snowflake.connector
 from snowflake.connector import DictCursor
-from datetime import datetime
+from aggregates import (TIMEFRAMES, AggregateStore, SortedSeries, Source,
+                        period_start, top_share)
+from names import NameIndex
+from metrics import (FRAGMENT_LOOKUPS, REQUESTS, ROUTE_CACHE, SERIALIZE,
+                     exposition, observe_query, register_stats)
+from replica import Replica
+from sketches import SketchFrame, registers_sql
+from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
+from contextlib import contextmanager
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from decimal import Decimal
+from functools import wraps
+from werkzeug.http import http_date
+from urllib.parse import urlencode
+import brotli
+import click
+import gzip
+import orjson
+import pyarrow as pa
+import hashlib
+import hmac
+import json
+import math
 import os
-import httpx
+import pickle
+import re
+import redis
+import threading
+import uuid
+import time
 import asyncio
 
 REDIS_LINK = os.environ['REDIS']
@@ -16,6 +43,96 @@ SNOWFLAKE_PASS = os.environ['SNOWFLAKE_PASS']
 SNOWFLAKE_ACCOUNT = os.environ['SNOWFLAKE_ACCOUNT']
 SNOWFLAKE_WAREHOUSE = os.environ['SNOWFLAKE_WAREHOUSE']
 
+SNOWFLAKE_POOL_SIZE = int(os.environ.get('SNOWFLAKE_POOL_SIZE', '8'))
+SNOWFLAKE_POOL_TIMEOUT = float(os.environ.get('SNOWFLAKE_POOL_TIMEOUT', '30'))
+SNOWFLAKE_CONN_MAX_AGE = int(os.environ.get('SNOWFLAKE_CONN_MAX_AGE', '3600'))
+SNOWFLAKE_CONN_IDLE_CHECK = int(
+  os.environ.get('SNOWFLAKE_CONN_IDLE_CHECK', '300'))
+QUERY_CONCURRENCY = int(os.environ.get('QUERY_CONCURRENCY', '8'))
+# statements are submitted asynchronously and polled, backing off from the
+# first interval to the max (seconds)
+QUERY_POLL_INTERVAL = float(os.environ.get('QUERY_POLL_INTERVAL', '0.1'))
+QUERY_POLL_MAX = float(os.environ.get('QUERY_POLL_MAX', '2'))
+# seconds a statement may run before it is cancelled; the statements of one
+# request also share a REQUEST_DEADLINE, background refreshes don't
+QUERY_TIMEOUT = float(os.environ.get('QUERY_TIMEOUT', '120'))
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', '30'))
+# statements known to scan ARBITRUM.RAW.TRANSACTIONS (the ?exact=1 and
+# cold-store paths of /overview, the grantees' txns_chart) get this long
+# instead, and being slow doesn't count against the breaker. Kept under
+# CACHE_LOCK_TTL so the fill lock outlives them.
+HEAVY_QUERY_TIMEOUT = float(os.environ.get('HEAVY_QUERY_TIMEOUT', '240'))
+# columnar fetches behind the replica and aggregate stores, which only run
+# in the background
+REFRESH_QUERY_TIMEOUT = float(os.environ.get('REFRESH_QUERY_TIMEOUT', '600'))
+# the breaker opens after this many consecutive failed or slow statements
+# and fails warehouse calls at once for BREAKER_COOLDOWN seconds
+BREAKER_FAILURES = int(os.environ.get('BREAKER_FAILURES', '5'))
+BREAKER_SLOW_SECONDS = float(os.environ.get('BREAKER_SLOW_SECONDS', '20'))
+BREAKER_COOLDOWN = float(os.environ.get('BREAKER_COOLDOWN', '30'))
+# entries built from an older data version are served stale while one
+# worker refreshes them. The soft TTL only applies while the version can't be
+# read; the hard TTL is when Redis drops an entry nobody asked for.
+CACHE_SOFT_TTL = int(os.environ.get('CACHE_SOFT_TTL', '14400'))
+CACHE_HARD_TTL = int(os.environ.get('CACHE_HARD_TTL', '604800'))
+CACHE_LOCK_TTL = int(os.environ.get('CACHE_LOCK_TTL', '300'))
+CACHE_LOCK_WAIT = float(os.environ.get('CACHE_LOCK_WAIT', '60'))
+CACHE_REFRESH_WORKERS = int(os.environ.get('CACHE_REFRESH_WORKERS', '2'))
+# per-statement result cache shared by all routes; 0 disables it. Keys
+# include the data version, so a dbt run never serves old fragments.
+FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL', '86400'))
+# optional per-worker memory tier in front of Redis for route responses;
+# 0 bytes disables it
+L1_CACHE_BYTES = int(os.environ.get('L1_CACHE_BYTES', '0'))
+L1_CACHE_TTL = int(os.environ.get('L1_CACHE_TTL', '60'))
+L1_INVALIDATE_CHANNEL = 'cache-invalidate'
+HIT_FLUSH_INTERVAL = int(os.environ.get('HIT_FLUSH_INTERVAL', '30'))
+# how often the data version is re-read from the warehouse metadata
+DATA_VERSION_TTL = int(os.environ.get('DATA_VERSION_TTL', '60'))
+# bearer token for POST /data-version, which the dbt job calls when a run
+# finishes; the endpoint is disabled when unset
+DATA_VERSION_TOKEN = os.environ.get('DATA_VERSION_TOKEN')
+# local per-project aggregates used to answer /overview?excludes=... without
+# a warehouse scan per exclude set; set AGGREGATE_STORE=0 to use the SQL path
+AGGREGATE_STORE = os.environ.get('AGGREGATE_STORE', '1') == '1'
+AGGREGATE_DIR = os.environ.get('AGGREGATE_DIR', '.aggregates')
+AGGREGATE_REFRESH_INTERVAL = int(
+  os.environ.get('AGGREGATE_REFRESH_INTERVAL', '900'))
+# refreshes only fetch from each frame's last date on; this often a frame
+# is read in full again, so history dbt rewrote (backfilled grantees,
+# remapped labels) reaches the store
+AGGREGATE_REBUILD_INTERVAL = int(
+  os.environ.get('AGGREGATE_REBUILD_INTERVAL', '86400'))
+# distinct-wallet metrics under excludes are estimated from HyperLogLog
+# sketches (about 1.6% standard error); ?exact=1 runs the warehouse queries
+HLL_SKETCHES = os.environ.get('HLL_SKETCHES', '1') == '1'
+HLL_HISTORY_DAYS = int(os.environ.get('HLL_HISTORY_DAYS', '400'))
+# Parquet snapshots of the dbt summary tables answered with DuckDB; statements
+# reading only those tables skip Snowflake while the snapshot is younger than
+# REPLICA_MAX_AGE, and fall back to it at any age when Snowflake fails
+LOCAL_REPLICA = os.environ.get('LOCAL_REPLICA', '1') == '1'
+REPLICA_DIR = os.environ.get('REPLICA_DIR', '.replica')
+REPLICA_REFRESH_INTERVAL = int(os.environ.get('REPLICA_REFRESH_INTERVAL',
+                                              '900'))
+REPLICA_MAX_AGE = int(os.environ.get('REPLICA_MAX_AGE', '3600'))
+WARM_CHAINS = os.environ.get('WARM_CHAINS', 'all,one').split(',')
+WARM_TIMESCALES = os.environ.get('WARM_TIMESCALES', '3,6,12').split(',')
+WARM_CONCURRENCY = int(os.environ.get('WARM_CONCURRENCY', '2'))
+# the warmer refreshes entries this many seconds before their soft TTL
+WARM_AHEAD = int(os.environ.get('WARM_AHEAD', '900'))
+CHAINS = ['all', 'one']
+# the longest /overview window, in months
+MAX_TIMESCALE = int(os.environ.get('MAX_TIMESCALE', '120'))
+GRANTEE_BATCH_MAX = int(os.environ.get('GRANTEE_BATCH_MAX', '100'))
+# how often the grantee name index is rebuilt while the data version can't
+# be read; otherwise it follows the version
+NAME_INDEX_REFRESH = int(os.environ.get('NAME_INDEX_REFRESH', '300'))
+SEARCH_LIMIT_MAX = 50
+
+# bump when a cached response or result changes shape so old entries are
+# ignored
+CACHE_KEY_VERSION = 'v3'
+
 config = {
   "CACHE_TYPE": "redis",
   "CACHE_DEFAULT_TIMEOUT": 14400,
@@ -28,151 +145,1626 @@ cache = Cache(app)
 CORS(app)
 
 
+# query parameters each route reads, with their defaults; a list default
+# marks a multi-valued parameter
+ROUTE_PARAMS = {
+  '/overview': {
+    'timeframe': 'month',
+    'timescale': '6',
+    'chain': 'all',
+    'excludes': [],
+    'exact': '0',
+    'since': '',
+  },
+  '/grantee': {
+    'timeframe': 'week',
+    'grantee_name': 'pendle',
+    'since': '',
+  },
+  '/grantee-public': {
+    'grantee_name': 'pendle',
+  },
+  '/grantees': {
+    'timeframe': 'week',
+    'grantee_name': [],
+    'sections': [],
+  },
+  '/search': {
+    'q': '',
+    'limit': '10',
+  },
+}
+# the per-grantee series /grantee returns and /grantees can select
+GRANTEE_SECTIONS = [
+  "wallets_chart", "gas_chart", "txns_chart", "tvl_chart", "milestones"
+]
+# the dated series each route trims to since= points
+OVERVIEW_CHARTS = [
+  "tvl_chart", "tvl_chart_eth", "accounts_chart", "tvl_chart_post_grant",
+  "tvl_chart_eth_post_grant", "accounts_chart_post_grant"
+]
+GRANTEE_CHARTS = ["wallets_chart", "gas_chart", "txns_chart", "tvl_chart"]
+
+
+def request_params(path=None):
+  defaults = ROUTE_PARAMS[path or request.path]
+  try:
+    args = request.args
+  except UnicodeDecodeError:
+    abort(400, 'the query string is not valid UTF-8')
+  params = {}
+  for name, default in defaults.items():
+    if isinstance(default, list):
+      params[name] = sorted(set(args.getlist(name))) or default
+    else:
+      params[name] = args.get(name, default)
+  # these end up in unquoted table names, which Snowflake reads in any case.
+  # They are checked here, before any cache key, store load or query is
+  # built from them.
+  for name, allowed in (('chain', CHAINS), ('timeframe', TIMEFRAMES)):
+    if name in params:
+      params[name] = params[name].lower()
+      if params[name] not in allowed:
+        abort(400, 'unknown %s: %s' % (name, params[name]))
+  if 'timescale' in params:
+    try:
+      timescale = int(params['timescale'])
+    except ValueError:
+      abort(400, 'timescale must be a number')
+    if not 1 <= timescale <= MAX_TIMESCALE:
+      abort(400, 'timescale must be between 1 and %d' % MAX_TIMESCALE)
+    # 06 and 6 share a cache entry
+    params['timescale'] = str(timescale)
+  return params
+
+
+def canonical_cache_key(path, params):
+  payload = json.dumps(params, sort_keys=True, separators=(',', ':'))
+  digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+  return '%s:%s:%s' % (CACHE_KEY_VERSION, path, digest)
+
+
 def make_cache_key(*args, **kwargs):
-  path = request.path
-  args = str(hash(frozenset(request.args.items())))
-  return (path + args).encode('utf-8')
+  return canonical_cache_key(request.path, request_params())
+
+
+def route_cache_key(path, **params):
+  # the key of a request to path passing params and defaulting the rest
+  return canonical_cache_key(path, dict(ROUTE_PARAMS[path], **params))
+
+
+def parse_since(value):
+  if not value:
+    return None
+  try:
+    return date.fromisoformat(value).isoformat()
+  except ValueError:
+    abort(400, 'since must be a YYYY-MM-DD date')
+
+
+def series_delta(response_data, since, charts):
+  # with since=, the chart series only carry points dated on or after it.
+  # The point at the cursor is sent again because its period may still have
+  # been open. cursor is the latest date the full series reached, to pass
+  # as the next since=.
+  if since is None:
+    return response_data
+  dates = [
+    str(row["DATE"])[:10] for chart in charts
+    for row in response_data.get(chart) or []
+  ]
+  for chart in charts:
+    if isinstance(response_data.get(chart), list):
+      response_data[chart] = [
+        row for row in response_data[chart] if str(row["DATE"])[:10] >= since
+      ]
+  response_data["cursor"] = max(dates, default=since)
+  return response_data
+
+
+class SingleFlight:
+  # collapses concurrent calls for the same key inside this process onto
+  # one execution; the other callers get the leader's result
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls = {}
+
+  def do(self, key, fn):
+    with self._lock:
+      call = self._calls.get(key)
+      leader = call is None
+      if leader:
+        call = self._calls[key] = Future()
+    if not leader:
+      return call.result()
+    try:
+      result = fn()
+    except Exception as e:
+      call.set_exception(e)
+      raise
+    else:
+      call.set_result(result)
+      return result
+    finally:
+      with self._lock:
+        del self._calls[key]
+
+
+single_flight = SingleFlight()
+refresh_executor = ThreadPoolExecutor(max_workers=CACHE_REFRESH_WORKERS)
+refreshing = set()
+refreshing_lock = threading.Lock()
+
+
+class MemoryCache:
+  # size-bounded LRU; entries are weighed by their pickled size once, when
+  # they are inserted
+
+  def __init__(self, max_bytes, ttl):
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self._data = OrderedDict()
+    self._bytes = 0
+    self._lock = threading.Lock()
+    self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+  def get(self, key):
+    with self._lock:
+      item = self._data.get(key)
+      if item is None or item[0] < time.monotonic():
+        if item is not None:
+          self._remove(key)
+        self._stats["misses"] += 1
+        return None
+      self._data.move_to_end(key)
+      self._stats["hits"] += 1
+      return item[2]
+
+  def set(self, key, value):
+    size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    if size > self.max_bytes:
+      return
+    with self._lock:
+      if key in self._data:
+        self._remove(key)
+      self._data[key] = (time.monotonic() + self.ttl, size, value)
+      self._bytes += size
+      while self._bytes > self.max_bytes:
+        self._remove(next(iter(self._data)))
+        self._stats["evictions"] += 1
+
+  def delete(self, key):
+    with self._lock:
+      if key in self._data:
+        self._remove(key)
+
+  def _remove(self, key):
+    _, size, _ = self._data.pop(key)
+    self._bytes -= size
+
+  def metrics(self):
+    with self._lock:
+      stats = dict(self._stats)
+      stats["entries"] = len(self._data)
+      stats["bytes"] = self._bytes
+    return stats
+
+
+l1_cache = MemoryCache(L1_CACHE_BYTES, L1_CACHE_TTL)
+l1_instance = uuid.uuid4().hex
+l1_listener_pid = None
+l1_listener_lock = threading.Lock()
+redis_client = redis.from_url(REDIS_LINK)
+
+
+def listen_for_invalidations():
+  while True:
+    try:
+      pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+      pubsub.subscribe(L1_INVALIDATE_CHANNEL)
+      for message in pubsub.listen():
+        sender, _, key = message["data"].decode('utf-8').partition(' ')
+        if sender != l1_instance:
+          l1_cache.delete(key)
+    except Exception:
+      app.logger.exception('cache invalidation listener failed')
+      time.sleep(5)
+
+
+def ensure_l1_listener():
+  # started lazily so each forked gunicorn worker gets its own subscriber
+  global l1_instance, l1_listener_pid
+  if l1_listener_pid == os.getpid():
+    return
+  with l1_listener_lock:
+    if l1_listener_pid == os.getpid():
+      return
+    l1_instance = uuid.uuid4().hex
+    threading.Thread(target=listen_for_invalidations, daemon=True).start()
+    l1_listener_pid = os.getpid()
+
+
+pending_hits = Counter()
+pending_hits_lock = threading.Lock()
+hits_flushed_at = time.monotonic()
+
+
+def record_hit(key):
+  # hit counts feed the warmer's priority order; they are buffered so a
+  # memory-tier hit doesn't pay a Redis round trip
+  global hits_flushed_at
+  with pending_hits_lock:
+    pending_hits[key] += 1
+    if time.monotonic() - hits_flushed_at < HIT_FLUSH_INTERVAL:
+      return
+    counts = dict(pending_hits)
+    pending_hits.clear()
+    hits_flushed_at = time.monotonic()
+  try:
+    pipe = redis_client.pipeline(transaction=False)
+    for hit_key, count in counts.items():
+      name = cache.cache.key_prefix + 'hits:' + hit_key
+      pipe.incrby(name, count)
+      # a key nobody asks for any more lapses with the entry it counts
+      pipe.expire(name, CACHE_HARD_TTL)
+    pipe.execute()
+  except Exception:
+    app.logger.exception('flushing cache hit counts failed')
+
+
+def load_entry(key):
+  if L1_CACHE_BYTES:
+    ensure_l1_listener()
+    entry = l1_cache.get(key)
+    if entry is not None:
+      return entry
+  entry = cache.get(key)
+  if entry is not None and L1_CACHE_BYTES:
+    l1_cache.set(key, entry)
+  return entry
+
+
+data_version_state = {"value": None, "checked": 0.0}
+data_version_lock = threading.Lock()
+
+
+def data_version(force=False):
+  # when the data last changed: the dbt tables' last change, or the start
+  # of today once the raw-transaction series roll over a day. Checked at
+  # most every DATA_VERSION_TTL seconds per worker and shared through Redis
+  # so the fleet makes one metadata query per interval; force skips both.
+  with data_version_lock:
+    if not force and (time.monotonic() - data_version_state["checked"] <
+                      DATA_VERSION_TTL):
+      return data_version_state["value"]
+    data_version_state["checked"] = time.monotonic()
+    previous = data_version_state["value"]
+  try:
+    version = None if force else cache.get('data-version')
+    if version is None:
+      if previous is None:
+        previous = cache.get('data-version')
+      # SHOW is answered from metadata without resuming the warehouse, which
+      # an INFORMATION_SCHEMA scan every interval would keep awake. dbt's
+      # create-or-replace models move created_on on every run.
+      rows, _ = run_sql('SHOW TABLES IN SCHEMA ARBIGRANTS.DBT',
+                        query_name='data_version')
+      today = datetime.now().astimezone().replace(hour=0,
+                                                  minute=0,
+                                                  second=0,
+                                                  microsecond=0)
+      version = max([row.get("last_altered") or row["created_on"]
+                     for row in rows] + [today])
+      cache.set('data-version', version, timeout=DATA_VERSION_TTL)
+  except Exception:
+    app.logger.exception('reading the data version failed')
+    version = previous
+  with data_version_lock:
+    data_version_state["value"] = version
+  if previous is not None and version is not None and version != previous:
+    schedule_prewarm(version)
+  return version
+
+
+def data_changed_at():
+  version = data_version()
+  return version.timestamp() if version is not None else None
+
+
+def schedule_prewarm(version):
+  # the first worker to see a new version refreshes what was cached under
+  # the old one, so requests find it rebuilt rather than stale
+  if not cache.add('prewarm:' + version.isoformat(),
+                   os.getpid(),
+                   timeout=CACHE_HARD_TTL):
+    return
+
+  def run():
+    try:
+      if LOCAL_REPLICA:
+        replica.sync()
+      stats = warm_cache(cached_only=True)
+      app.logger.info(
+        'data version %s: refreshed %d of %d outdated entries in %.1fs',
+        version.isoformat(), stats["refreshed"], stats["stale"],
+        stats["seconds"])
+    except Exception:
+      app.logger.exception('pre-warming data version %s failed',
+                           version.isoformat())
+
+  threading.Thread(target=run, daemon=True).start()
+
+
+def data_etag(key, version, encoding, degraded=False):
+  # each encoding's bytes get their own tag, as a strong validator requires,
+  # and a payload built from stale fallbacks gets its own tag, so a client
+  # holding it is sent the full payload once the warehouse is back
+  if version is None:
+    return None
+  tag = '%s|%s|%s%s' % (version.isoformat(), key, encoding,
+                        '|degraded' if degraded else '')
+  return hashlib.sha256(tag.encode('utf-8')).hexdigest()[:32]
+
+
+def store_entry(key, value, version):
+  # a payload built from the replica's stale fallback is marked so it is
+  # refreshed once the warehouse answers again
+  degraded = has_request_context() and g.get('degraded', False)
+  meta = {
+    "created": time.time(),
+    "version": version,
+    "degraded": degraded,
+  }
+  entry = dict(meta, value=value)
+  # the warmer only needs to know how old an entry is, so that is also kept
+  # apart from the payload
+  cache.set_many({key: entry, 'meta:' + key: meta}, timeout=CACHE_HARD_TTL)
+  if L1_CACHE_BYTES:
+    ensure_l1_listener()
+    l1_cache.set(key, entry)
+    redis_client.publish(L1_INVALIDATE_CHANNEL, l1_instance + ' ' + key)
+  return entry
+
+
+def lock_wait_deadline():
+  # how long a request polls for another worker's result: CACHE_LOCK_WAIT,
+  # or less when the request's own deadline is nearer, past which its
+  # queries would fail anyway
+  deadline = time.monotonic() + CACHE_LOCK_WAIT
+  if has_request_context() and 'deadline' in g:
+    deadline = min(deadline, g.deadline)
+  return deadline
+
+
+def fill_entry(key, compute):
+  # the Redis lock makes one worker in the fleet compute a missing key; the
+  # rest poll for its result and only compute themselves if it never lands
+  lock_key = 'lock:' + key
+  version = data_version()
+  if cache.add(lock_key, os.getpid(), timeout=CACHE_LOCK_TTL):
+    try:
+      return store_entry(key, compute(), version)
+    finally:
+      cache.delete(lock_key)
+
+  deadline = lock_wait_deadline()
+  while time.monotonic() < deadline:
+    time.sleep(0.25)
+    entry = load_entry(key)
+    if entry is not None:
+      return entry
+  return store_entry(key, compute(), version)
+
+
+def refresh_entry(key, view, path, query_string):
+  lock_key = 'lock:' + key
+  try:
+    if not cache.add(lock_key, os.getpid(), timeout=CACHE_LOCK_TTL):
+      return False
+    try:
+      version = data_version()
+      with app.test_request_context(path, query_string=query_string):
+        data = app.ensure_sync(view)()
+        store_entry(key, encode_payload(data), version)
+    finally:
+      cache.delete(lock_key)
+    return True
+  except Exception:
+    app.logger.exception('background refresh of %s failed', key)
+    return False
+  finally:
+    with refreshing_lock:
+      refreshing.discard(key)
+
+
+def schedule_refresh(key, view):
+  with refreshing_lock:
+    if key in refreshing:
+      return
+    refreshing.add(key)
+  refresh_executor.submit(refresh_entry, key, view, request.path,
+                          request.query_string.decode('latin-1'))
+
+
+def json_default(value):
+  # matches what jsonify produced for the warehouse types
+  if isinstance(value, Decimal):
+    return str(value)
+  if isinstance(value, (date, datetime)):
+    return http_date(value)
+  raise TypeError
+
+
+def encode_payload(data):
+  # a route's response serialized once and stored in every encoding we
+  # serve, so a cache hit is only a byte copy
+  start = time.perf_counter()
+  body = orjson.dumps(data,
+                      default=json_default,
+                      option=orjson.OPT_SORT_KEYS
+                      | orjson.OPT_PASSTHROUGH_DATETIME)
+  payload = {
+    "identity": body,
+    "gzip": gzip.compress(body, 6),
+    "br": brotli.compress(body, quality=9),
+  }
+  SERIALIZE.labels(current_route()).observe(time.perf_counter() - start)
+  return payload
+
+
+def response_encoding():
+  # which of a payload's stored encodings this request is sent
+  return request.accept_encodings.best_match(['br', 'gzip']) or 'identity'
+
+
+def payload_response(entry, key):
+  encoding = response_encoding()
+  response = app.response_class(entry["value"][encoding],
+                                mimetype='application/json')
+  if encoding != 'identity':
+    response.headers['Content-Encoding'] = encoding
+  response.headers['Vary'] = 'Accept-Encoding'
+  if entry.get("degraded"):
+    response.headers['X-Degraded'] = 'warehouse-unavailable'
+  # the validators describe the data this payload was built from, which
+  # can be older than the current version while a refresh is pending
+  etag = data_etag(key, entry.get("version"), encoding,
+                   entry.get("degraded"))
+  if etag:
+    response.set_etag(etag)
+    # If-Modified-Since can't tell a degraded payload from a healthy one
+    if not entry.get("degraded"):
+      response.last_modified = entry["version"]
+  return response
+
+
+def not_modified(key, version):
+  etag = data_etag(key, version, response_encoding())
+  if etag is None:
+    return None
+  if request.if_none_match:
+    if not request.if_none_match.contains(etag):
+      return None
+  elif not (request.if_modified_since and int(version.timestamp()) <=
+            request.if_modified_since.timestamp()):
+    return None
+  response = app.response_class(status=304)
+  response.set_etag(etag)
+  response.last_modified = version
+  response.headers['Vary'] = 'Accept-Encoding'
+  return response
+
+
+def entry_outdated(entry, version, max_age):
+  # entries live until the data changes; age only counts when the version
+  # can't be read
+  if entry.get("degraded"):
+    return True
+  if version is not None:
+    return entry.get("version") != version
+  return time.time() - entry["created"] > max_age
+
+
+def cached_response(key, view):
+  # the part of a cached route that never runs the view: validators, the
+  # cache lookup and scheduling a stale refresh. None means a miss.
+  record_hit(key)
+  version = data_version()
+  # answered before the payload is read; a client holding a degraded
+  # payload has its tag, which never matches the healthy one checked here
+  response = not_modified(key, version)
+  if response is not None:
+    ROUTE_CACHE.labels(request.path, 'not_modified').inc()
+    return response
+
+  entry = load_entry(key)
+  if entry is None:
+    ROUTE_CACHE.labels(request.path, 'miss').inc()
+    return None
+  if entry_outdated(entry, version, CACHE_SOFT_TTL):
+    ROUTE_CACHE.labels(request.path, 'stale').inc()
+    if warehouse_breaker.tripped():
+      # a refresh would only fail at the breaker; serve what we have
+      response = payload_response(entry, key)
+      response.headers['X-Degraded'] = 'warehouse-unavailable'
+      return response
+    schedule_refresh(key, view)
+  else:
+    ROUTE_CACHE.labels(request.path, 'hit').inc()
+  return payload_response(entry, key)
+
+
+def swr_cached(view):
+  # views are coroutines returning plain dicts; the wrapper caches them as
+  # encoded payloads. Under WSGI the view runs on a per-request event loop,
+  # asgi.py awaits it directly.
+
+  @wraps(view)
+  def wrapper(*args, **kwargs):
+    key = make_cache_key()
+    response = cached_response(key, view)
+    if response is not None:
+      return response
+    entry = single_flight.do(
+      key, lambda: fill_entry(
+        key, lambda: encode_payload(app.ensure_sync(view)
+                                    (*args, **kwargs))))
+    return payload_response(entry, key)
+
+  wrapper.cached_view = view
+  return wrapper
+
+
+def project_names():
+  rows = execute_sql('''
+  SELECT NAME FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA
+  ''', query_name='name_list')
+  return [row["NAME"] for row in rows]
+
+
+name_index = NameIndex(project_names, data_version, NAME_INDEX_REFRESH)
+
+
+def warm_targets():
+  targets = []
+  for chain in WARM_CHAINS:
+    for timeframe in TIMEFRAMES:
+      for timescale in WARM_TIMESCALES:
+        targets.append(('/overview', {
+          'chain': chain,
+          'timeframe': timeframe,
+          'timescale': timescale
+        }))
+
+  for name in project_names():
+    for timeframe in TIMEFRAMES:
+      targets.append(('/grantee', {
+        'timeframe': timeframe,
+        'grantee_name': name
+      }))
+    targets.append(('/grantee-public', {'grantee_name': name}))
+  return targets
+
+
+def warm_cache(cached_only=False):
+  # refresh every known parameter combination that is missing or built from
+  # an older data version, most requested first; cached_only leaves out the
+  # ones nobody has asked for
+  start = time.monotonic()
+  version = data_version()
+  jobs = []
+  for path, params in warm_targets():
+    query_string = urlencode(params)
+    with app.test_request_context(path, query_string=query_string):
+      key = make_cache_key()
+      view = app.view_functions[request.endpoint].__wrapped__
+    jobs.append((key, view, path, query_string))
+
+  keys = [job[0] for job in jobs]
+  hits = dict(zip(keys, cache.get_many(*['hits:' + key for key in keys])))
+  # each entry's age, without its payload
+  meta = dict(zip(keys, cache.get_many(*['meta:' + key for key in keys])))
+  jobs.sort(key=lambda job: hits[job[0]] or 0, reverse=True)
+
+  stale = [
+    job for job in jobs
+    if (meta[job[0]] is None and not cached_only) or (
+      meta[job[0]] is not None and entry_outdated(
+        meta[job[0]], version, CACHE_SOFT_TTL - WARM_AHEAD))
+  ]
+  with ThreadPoolExecutor(max_workers=WARM_CONCURRENCY) as executor:
+    refreshed = sum(executor.map(lambda job: refresh_entry(*job), stale))
+
+  return {
+    "targets": len(jobs),
+    "stale": len(stale),
+    "refreshed": refreshed,
+    "seconds": time.monotonic() - start,
+  }
 
 
-def execute_sql(sql_string, **kwargs):
-  conn = snowflake.connector.connect(user=SNOWFLAKE_USER,
+@app.cli.command('warm')
+@click.option('--interval',
+              default=0,
+              help='Repeat the warm-up every N seconds instead of once.')
+def warm_command(interval):
+  while True:
+    stats = warm_cache()
+    click.echo('warmed {refreshed}/{stale} stale of {targets} entries '
+               'in {seconds:.1f}s'.format(**stats))
+    if not interval:
+      break
+    time.sleep(interval)
+
+
+class PoolTimeout(Exception):
+  pass
+
+
+class WarehouseUnavailable(Exception):
+  pass
+
+
+class QueryTimeout(WarehouseUnavailable):
+  pass
+
+
+class CircuitBreaker:
+  # Opens after `failures` consecutive failed or slow calls. While open,
+  # calls are refused for `cooldown` seconds; then one trial call is let
+  # through and its outcome closes or reopens the breaker.
+
+  def __init__(self, failures, slow, cooldown):
+    self.failures = failures
+    self.slow = slow
+    self.cooldown = cooldown
+    self._lock = threading.Lock()
+    self._consecutive = 0
+    self._opened_at = None
+    self._trial_at = float('-inf')
+    self._trips = 0
+
+  def tripped(self):
+    with self._lock:
+      return self._opened_at is not None
+
+  def allow(self):
+    with self._lock:
+      if self._opened_at is None:
+        return True
+      now = time.monotonic()
+      # a trial that never reported back doesn't block the next one
+      if (now - self._opened_at < self.cooldown
+          or now - self._trial_at < self.cooldown):
+        return False
+      self._trial_at = now
+      return True
+
+  def record(self, ok, seconds=None):
+    slow = seconds is not None and self.slow and seconds > self.slow
+    with self._lock:
+      if ok and not slow:
+        self._consecutive = 0
+        self._opened_at = None
+        return
+      self._consecutive += 1
+      if self._opened_at is not None or self._consecutive >= self.failures:
+        if self._opened_at is None:
+          self._trips += 1
+        self._opened_at = time.monotonic()
+
+  def metrics(self):
+    with self._lock:
+      return {
+        "open": 1 if self._opened_at is not None else 0,
+        "consecutive_failures": self._consecutive,
+        "trips": self._trips,
+      }
+
+
+class ConnectionPool:
+  # Bounded per-worker pool. Idle connections are pinged before reuse once
+  # they have sat for idle_check seconds, and recycled after max_age seconds
+  # so long-lived sessions don't outlive their Snowflake token.
+
+  def __init__(self, connect, size, timeout, max_age, idle_check):
+    self._connect = connect
+    self.size = size
+    self.timeout = timeout
+    self.max_age = max_age
+    self.idle_check = idle_check
+    self._cond = threading.Condition()
+    self._reset()
+
+  def _reset(self):
+    self._pid = os.getpid()
+    self._idle = deque()
+    self._open = 0
+    self._stats = {
+      "checkouts": 0,
+      "connects": 0,
+      "recycled": 0,
+      "failed_checks": 0,
+      "timeouts": 0,
+      "wait_total": 0.0,
+      "wait_max": 0.0,
+    }
+
+  def _check_pid(self):
+    # connections inherited across a fork share sockets with the parent, so
+    # the child forgets them instead of closing them
+    if self._pid != os.getpid():
+      self._reset()
+
+  def _healthy(self, conn, created, last_used):
+    now = time.monotonic()
+    if conn.is_closed():
+      return False
+    if now - created > self.max_age:
+      self._count("recycled")
+      return False
+    if now - last_used > self.idle_check:
+      try:
+        conn.cursor().execute('SELECT 1').close()
+      except Exception:
+        self._count("failed_checks")
+        return False
+    return True
+
+  def _count(self, name):
+    with self._cond:
+      self._stats[name] += 1
+
+  def _discard(self, conn):
+    try:
+      conn.close()
+    except Exception:
+      pass
+    with self._cond:
+      self._open -= 1
+      self._cond.notify()
+
+  def acquire(self):
+    start = time.monotonic()
+    deadline = start + self.timeout
+    while True:
+      with self._cond:
+        self._check_pid()
+        while not self._idle and self._open >= self.size:
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            self._stats["timeouts"] += 1
+            raise PoolTimeout('no Snowflake connection free after %ss' %
+                              self.timeout)
+          self._cond.wait(remaining)
+        if self._idle:
+          conn, created, last_used = self._idle.pop()
+        else:
+          self._open += 1
+          conn = None
+      if conn is None:
+        try:
+          conn = self._connect()
+        except Exception:
+          with self._cond:
+            self._open -= 1
+            self._cond.notify()
+          raise
+        created = time.monotonic()
+        self._count("connects")
+        break
+      if self._healthy(conn, created, last_used):
+        break
+      self._discard(conn)
+
+    waited = time.monotonic() - start
+    with self._cond:
+      self._stats["checkouts"] += 1
+      self._stats["wait_total"] += waited
+      self._stats["wait_max"] = max(self._stats["wait_max"], waited)
+    return conn, created
+
+  def release(self, conn, created):
+    with self._cond:
+      if self._pid != os.getpid():
+        return
+    if conn.is_closed() or time.monotonic() - created > self.max_age:
+      self._discard(conn)
+      return
+    with self._cond:
+      self._idle.append((conn, created, time.monotonic()))
+      self._cond.notify()
+
+  @contextmanager
+  def connection(self):
+    conn, created = self.acquire()
+    try:
+      yield conn
+    finally:
+      self.release(conn, created)
+
+  def metrics(self):
+    with self._cond:
+      stats = dict(self._stats)
+      stats["open"] = self._open
+      stats["idle"] = len(self._idle)
+      stats["size"] = self.size
+    stats["wait_avg"] = (stats["wait_total"] / stats["checkouts"]
+                         if stats["checkouts"] else 0.0)
+    return stats
+
+
+def snowflake_connect():
+  return snowflake.connector.connect(user=SNOWFLAKE_USER,
                                      password=SNOWFLAKE_PASS,
                                      account=SNOWFLAKE_ACCOUNT,
                                      warehouse=SNOWFLAKE_WAREHOUSE,
                                      database="ARBIGRANTS",
-                                     schema="DBT")
-
-  sql = sql_string.format(**kwargs)
-  res = conn.cursor(DictCursor).execute(sql)
-  results = res.fetchall()
-  conn.close()
+                                     schema="DBT",
+                                     paramstyle='qmark',
+                                     client_session_keep_alive=True,
+                                     # keeps scaled NUMBERs Decimal in Arrow
+                                     # results, as DictCursor returns them
+                                     arrow_number_to_decimal=True)
+
+
+snowflake_pool = ConnectionPool(snowflake_connect,
+                                size=SNOWFLAKE_POOL_SIZE,
+                                timeout=SNOWFLAKE_POOL_TIMEOUT,
+                                max_age=SNOWFLAKE_CONN_MAX_AGE,
+                                idle_check=SNOWFLAKE_CONN_IDLE_CHECK)
+register_stats('arbigrants_snowflake_pool',
+               'Snowflake connection pool statistics of this worker.',
+               snowflake_pool.metrics)
+register_stats('arbigrants_l1_cache',
+               'In-process route cache statistics of this worker.',
+               l1_cache.metrics)
+
+warehouse_breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_SLOW_SECONDS,
+                                   BREAKER_COOLDOWN)
+register_stats('arbigrants_warehouse_breaker',
+               'Warehouse circuit breaker state of this worker.',
+               warehouse_breaker.metrics)
+
+
+@contextmanager
+def breaker_guard(timed=True):
+  # every warehouse call goes through the breaker; untimed calls are
+  # expected to be slow, so only their failures count
+  if not warehouse_breaker.allow():
+    raise WarehouseUnavailable('the warehouse circuit breaker is open')
+  start = time.monotonic()
+  try:
+    yield
+  except PoolTimeout:
+    # contention for this worker's own connections says nothing about the
+    # warehouse
+    raise
+  except Exception:
+    warehouse_breaker.record(False)
+    raise
+  warehouse_breaker.record(True, time.monotonic() - start if timed else None)
+
+
+def query_timeout(heavy=False):
+  # seconds the next statement may run: QUERY_TIMEOUT, or less when the
+  # request's deadline is nearer. A heavy statement is slow by design and
+  # isn't held to the request's deadline.
+  if heavy:
+    return HEAVY_QUERY_TIMEOUT
+  timeout = QUERY_TIMEOUT
+  if has_request_context() and 'deadline' in g:
+    timeout = min(timeout, g.deadline - time.monotonic())
+  if timeout <= 0:
+    raise QueryTimeout('the request deadline has passed')
+  return timeout
+
+
+def cancel_query(query_id):
+  try:
+    with snowflake_pool.connection() as conn:
+      with conn.cursor() as cur:
+        cur.execute('SELECT SYSTEM$CANCEL_QUERY(?)', [query_id])
+  except Exception:
+    app.logger.exception('cancelling query %s failed', query_id)
+
+
+async def execute_many(queries, concurrency=None, heavy=()):
+  # queries maps a result name to (sql_string, format kwargs); the statements
+  # must be independent of each other since they run concurrently. The ones
+  # named in heavy run under HEAVY_QUERY_TIMEOUT.
+  limit = asyncio.Semaphore(concurrency or QUERY_CONCURRENCY)
+
+  async def run(name, sql, kwargs):
+    async with limit:
+      return await execute_sql_async(sql,
+                                     query_name=name,
+                                     heavy=name in heavy,
+                                     **kwargs)
+
+  tasks = [
+    asyncio.ensure_future(run(name, sql, kwargs))
+    for name, (sql, kwargs) in queries.items()
+  ]
+  try:
+    results = await asyncio.gather(*tasks)
+  except BaseException:
+    # the response fails with the first statement, so the rest stop too;
+    # a cancelled statement cancels its warehouse query
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    raise
+  return dict(zip(queries, results))
+
+
+def drop_column(rows, column):
+  return [{k: v for k, v in row.items() if k != column} for row in rows]
+
+
+# values the identifier placeholders in a statement template may take; they
+# name tables and date parts, so they are spliced into the text rather than
+# bound
+SQL_IDENTIFIERS = {
+  'time': TIMEFRAMES,
+  'chain': CHAINS,
+  'time_param': ['1 day', '7 day', '1 month'],
+}
+BIND_PARAM = re.compile(r'(?<![:\w]):(\w+)')
+
+
+def render_sql(sql_string, kwargs):
+  # (statement, bind values) for a template: {name} placeholders take a
+  # whitelisted identifier, :name placeholders become server-side binds, one
+  # per element for a list. The text only varies with the identifiers, so
+  # Snowflake can reuse its plan and result cache across values.
+  identifiers = {}
+  values = {}
+  for name, value in kwargs.items():
+    if name in SQL_IDENTIFIERS:
+      if value not in SQL_IDENTIFIERS[name]:
+        abort(400, 'unknown %s: %s' % (name, value))
+      identifiers[name] = value
+    else:
+      values[name] = value
+
+  params = []
+
+  def bind(match):
+    if match.group(1) not in values:
+      return match.group(0)
+    value = values[match.group(1)]
+    if isinstance(value, (list, tuple)):
+      params.extend(value)
+      return ', '.join('?' * len(value))
+    params.append(value)
+    return '?'
+
+  sql = BIND_PARAM.sub(bind, sql_string.format(**identifiers))
+  return sql, params
+
+
+def fragment_key(sql, params, version):
+  normalized = '%s|%s|%s' % (version, ' '.join(sql.split()),
+                             json.dumps(params, default=str))
+  digest = hashlib.sha256(normalized.encode('utf-8')).hexdigest()[:32]
+  return '%s:fragment:%s' % (CACHE_KEY_VERSION, digest)
+
+
+def current_route():
+  return request.path if has_request_context() else ''
+
+
+def result_size(rows):
+  return len(pickle.dumps(rows, pickle.HIGHEST_PROTOCOL))
+
+
+def replica_rows(sql, params, query_name, stale=False, arrow=False):
+  # the local replica's answer, or None when it can't give one
+  if not LOCAL_REPLICA:
+    return None
+  start = time.perf_counter()
+  rows = replica.query(sql, params, stale, arrow)
+  if rows is not None:
+    observe_query(current_route(), query_name, 0.0,
+                  time.perf_counter() - start, len(rows), result_size(rows),
+                  'replica')
+  return rows
+
+
+def warehouse_fallback(sql, params, query_name, arrow=False):
+  rows = replica_rows(sql, params, query_name, stale=True, arrow=arrow)
+  if rows is not None:
+    app.logger.warning('Snowflake failed on %s, answered from the replica',
+                       query_name)
+    if has_request_context():
+      g.degraded = True
+  return rows
+
+
+def run_sql(sql, params=None, query_name='sql'):
+  # (rows, stale): stale marks the replica's fallback for a failed query,
+  # which must not be cached as the current version's answer
+  rows = replica_rows(sql, params, query_name)
+  if rows is not None:
+    return rows, False
+  try:
+    return query_warehouse(sql, params, query_name), False
+  except Exception:
+    rows = warehouse_fallback(sql, params, query_name)
+    if rows is None:
+      raise
+    return rows, True
+
+
+def query_warehouse(sql, params, query_name):
+  # the connector cancels the statement once the timeout passes
+  timeout = math.ceil(query_timeout())
+  start = time.perf_counter()
+  with breaker_guard(), snowflake_pool.connection() as conn:
+    connected = time.perf_counter()
+    with conn.cursor(DictCursor) as cur:
+      rows = cur.execute(sql, params, timeout=timeout).fetchall()
+      query_id = cur.sfqid
+  observe_query(current_route(), query_name, connected - start,
+                time.perf_counter() - connected, len(rows), result_size(rows),
+                query_id)
+  return rows
+
+
+def fetch_arrow(sql, query_name='aggregate'):
+  # columnar fetch for large results; None when the statement returns no rows
+  start = time.perf_counter()
+  with breaker_guard(timed=False), snowflake_pool.connection() as conn:
+    connected = time.perf_counter()
+    with conn.cursor() as cur:
+      cur.execute(sql, timeout=math.ceil(REFRESH_QUERY_TIMEOUT))
+      table = cur.fetch_arrow_all()
+      query_id = cur.sfqid
+  observe_query(current_route(), query_name, connected - start,
+                time.perf_counter() - connected,
+                table.num_rows if table is not None else 0,
+                table.nbytes if table is not None else 0, query_id)
+  return table
+
+
+def submit_sql(sql, params, **kwargs):
+  # (query id, seconds spent waiting for the connection)
+  start = time.perf_counter()
+  with snowflake_pool.connection() as conn:
+    connected = time.perf_counter() - start
+    with conn.cursor() as cur:
+      cur.execute_async(sql, params, **kwargs)
+      return cur.sfqid, connected
+
+
+def query_running(query_id):
+  with snowflake_pool.connection() as conn:
+    status = conn.get_query_status_throw_if_error(query_id)
+    return conn.is_still_running(status)
+
+
+def fetch_results(query_id, statements=1, columnar=()):
+  # one result per statement: rows, or an Arrow table for the statement
+  # indexes in columnar
+  with snowflake_pool.connection() as conn:
+    with conn.cursor(DictCursor) as cur:
+      cur.get_results_from_sfqid(query_id)
+      results = []
+      for index in range(statements):
+        if index:
+          cur.nextset()
+        if index in columnar:
+          # no table at all for an empty result
+          results.append(cur.fetch_arrow_all() or pa.table({}))
+        else:
+          results.append(cur.fetchall())
+      return results
+
+
+async def run_sql_async(sql,
+                        params=None,
+                        statements=1,
+                        query_name='sql',
+                        heavy=False):
+  # (results, stale) as run_sql; multi-statement batches are routed per
+  # statement by execute_batch
+  if statements == 1:
+    rows = await asyncio.to_thread(replica_rows, sql, params, query_name)
+    if rows is not None:
+      return [rows], False
+  try:
+    return await query_warehouse_async(sql,
+                                       params,
+                                       statements,
+                                       query_name,
+                                       heavy=heavy), False
+  except Exception:
+    if statements > 1:
+      raise
+    rows = await asyncio.to_thread(warehouse_fallback, sql, params,
+                                   query_name)
+    if rows is None:
+      raise
+    return [rows], True
+
+
+async def query_warehouse_async(sql,
+                                params,
+                                statements,
+                                query_name,
+                                columnar=(),
+                                heavy=False):
+  # the statement keeps running after the submitting cursor is released, so
+  # a pooled connection is only held to submit, poll and fetch, never while
+  # the warehouse works; one result set per statement
+  start = time.perf_counter()
+  deadline = time.monotonic() + query_timeout(heavy)
+  kwargs = {"num_statements": statements} if statements > 1 else {}
+  with breaker_guard(timed=not heavy):
+    query_id, connect = await asyncio.to_thread(submit_sql, sql, params,
+                                                **kwargs)
+    try:
+      delay = QUERY_POLL_INTERVAL
+      while await asyncio.to_thread(query_running, query_id):
+        if time.monotonic() >= deadline:
+          raise QueryTimeout('query %s ran past its deadline' % query_id)
+        await asyncio.sleep(min(delay, deadline - time.monotonic()))
+        delay = min(delay * 2, QUERY_POLL_MAX)
+    except BaseException:
+      # nobody waits for the statement any more, so stop it; not awaited,
+      # the task may be cancelled itself
+      threading.Thread(target=cancel_query, args=(query_id,),
+                       daemon=True).start()
+      raise
+    results = await asyncio.to_thread(fetch_results, query_id, statements,
+                                      columnar)
+  size = await asyncio.to_thread(result_size, results)
+  observe_query(current_route(), query_name, connect,
+                time.perf_counter() - start - connect,
+                sum(len(rows) for rows in results), size, query_id)
   return results
 
 
-@app.route('/overview')
-@cache.memoize(make_name=make_cache_key)
-def overview():
-  timeframe = request.args.get('timeframe', 'month')
-  timescale = request.args.get('timescale', '6')
-  timescale = int(timescale)
-  chain = request.args.get('chain', 'all')
+def execute_sql(sql_string, query_name='sql', **kwargs):
+  sql, params = render_sql(sql_string, kwargs)
+  if FRAGMENT_CACHE_TTL:
+    key = fragment_key(sql, params, data_version())
+    results = cache.get(key)
+    lookup = 'miss' if results is None else 'hit'
+    FRAGMENT_LOOKUPS.labels(current_route(), query_name, lookup).inc()
+    if results is not None:
+      return results
 
-  excludes = request.args.getlist('excludes')
-  exclude_list = ",".join(f"'{item}'" for item in excludes) if excludes else ""
+  results, stale = run_sql(sql, params, query_name)
 
-  current_date = datetime.now()
-  previous_month = current_date.replace(day=1) - relativedelta(
-    months=timescale)
-  start_month = previous_month.strftime('%Y-%m-%d')
+  if FRAGMENT_CACHE_TTL and not stale:
+    cache.set(key, results, timeout=FRAGMENT_CACHE_TTL)
+  return results
 
-  if exclude_list == "":
-    cards_query = execute_sql('''
-    SELECT {time}_ACTIVE_WALLETS AS ACTIVE_WALLETS,
-    PCT_{time}_ACTIVE_WALLETS AS PCT_WALLETS,
-    TVL_GRANTEES,
-    {time}_GAS_SPEND AS GAS_SPEND,
-    PCT_{time}_GAS_SPEND AS PCT_GAS_SPEND
-    FROM ARBIGRANTS.DBT.ARBIGRANTS_{chain}_SUMMARY
-   ''',
-                              time=timeframe,
-                              chain=chain)
 
-    wallets_stat = [{"ACTIVE_WALLETS": cards_query[0]["ACTIVE_WALLETS"]}]
+async def execute_sql_async(sql_string, query_name='sql', heavy=False,
+                            **kwargs):
+  sql, params = render_sql(sql_string, kwargs)
+  if FRAGMENT_CACHE_TTL:
+    key = fragment_key(sql, params, await asyncio.to_thread(data_version))
+    results = await asyncio.to_thread(cache.get, key)
+    lookup = 'miss' if results is None else 'hit'
+    FRAGMENT_LOOKUPS.labels(current_route(), query_name, lookup).inc()
+    if results is not None:
+      return results
+
+  results, stale = await run_sql_async(sql,
+                                       params,
+                                       query_name=query_name,
+                                       heavy=heavy)
+  results = results[0]
+
+  if FRAGMENT_CACHE_TTL and not stale:
+    await asyncio.to_thread(cache.set, key, results,
+                            timeout=FRAGMENT_CACHE_TTL)
+  return results
 
-    wallets_pct_stat = [{"PCT_WALLETS": cards_query[0]["PCT_WALLETS"]}]
 
-    tvl_stat = [{"TVL_GRANTEES": cards_query[0]["TVL_GRANTEES"]}]
+aggregate_store = AggregateStore(
+  fetch_arrow, {
+    'tvl':
+    Source.table('ARBIGRANTS_ONE_{time}_TVL_BY_PROJECT', ['TVL', 'TVL_ETH']),
+    'wallets':
+    Source.table('ARBIGRANTS_ONE_{time}_ACTIVE_WALLETS_BY_PROJECT',
+                 ['ACTIVE_WALLETS']),
+    'wallet_sketch':
+    Source(registers_sql('''
+    SELECT c.NAME, TO_DATE(t.BLOCK_TIMESTAMP) AS DATE, HASH(t.FROM_ADDRESS) AS H
+    FROM ARBITRUM.RAW.TRANSACTIONS t
+    INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_CONTRACTS c
+    ON c.CONTRACT_ADDRESS = t.TO_ADDRESS
+    AND t.BLOCK_TIMESTAMP < CURRENT_DATE
+    AND t.BLOCK_TIMESTAMP >= '{since}'
+    INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA m
+    ON m.NAME = c.NAME
+    AND m.CHAIN = 'Arbitrum One'
+    '''), ['IDX', 'RANK'],
+           frame_type=SketchFrame,
+           history_days=HLL_HISTORY_DAYS),
+    'all_wallet_sketch':
+    Source(registers_sql('''
+    SELECT '*' AS NAME, TO_DATE(BLOCK_TIMESTAMP) AS DATE, HASH(FROM_ADDRESS) AS H
+    FROM ARBITRUM.RAW.TRANSACTIONS
+    WHERE BLOCK_TIMESTAMP < CURRENT_DATE
+    AND BLOCK_TIMESTAMP >= '{since}'
+    '''), ['IDX', 'RANK'],
+           frame_type=SketchFrame,
+           history_days=HLL_HISTORY_DAYS),
+    'gas':
+    Source('''
+    SELECT c.NAME, TO_DATE(t.BLOCK_TIMESTAMP) AS DATE,
+    SUM((RECEIPT_EFFECTIVE_GAS_PRICE * RECEIPT_GAS_USED)/1e18) AS GAS_SPEND
+    FROM ARBITRUM.RAW.TRANSACTIONS t
+    INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_CONTRACTS c
+    ON c.CONTRACT_ADDRESS = t.TO_ADDRESS
+    AND t.BLOCK_TIMESTAMP < CURRENT_DATE
+    AND t.BLOCK_TIMESTAMP >= '{since}'
+    INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA m
+    ON m.NAME = c.NAME
+    AND m.CHAIN = 'Arbitrum One'
+    GROUP BY 1, 2
+    ''', ['GAS_SPEND'],
+           history_days=HLL_HISTORY_DAYS),
+    'all_gas':
+    Source('''
+    SELECT '*' AS NAME, TO_DATE(BLOCK_TIMESTAMP) AS DATE,
+    SUM((RECEIPT_EFFECTIVE_GAS_PRICE * RECEIPT_GAS_USED)/1e18) AS GAS_SPEND
+    FROM ARBITRUM.RAW.TRANSACTIONS
+    WHERE BLOCK_TIMESTAMP < CURRENT_DATE
+    AND BLOCK_TIMESTAMP >= '{since}'
+    GROUP BY 1, 2
+    ''', ['GAS_SPEND'],
+           history_days=HLL_HISTORY_DAYS),
+  }, AGGREGATE_DIR, AGGREGATE_REFRESH_INTERVAL, data_changed_at,
+  AGGREGATE_REBUILD_INTERVAL)
+
+replica = Replica(
+  lambda sql: fetch_arrow(sql, 'replica'),
+  ['ARBIGRANTS_%s_%s' % (chain, table)
+   for chain in ('ALL', 'ONE') for table in ('SUMMARY', 'TVL_PIE')] + [
+     'ARBIGRANTS_%s_%s_%s' % (chain, timeframe, table)
+     for chain in ('ALL', 'ONE') for timeframe in TIMEFRAMES
+     for table in ('TVL', 'TVL_POST_GRANT', 'ACTIVE_WALLETS',
+                   'ACTIVE_WALLETS_POST_GRANT', 'WALLETS_PIE', 'LEADERBOARD',
+                   'TVL_BY_PROJECT', 'ACTIVE_WALLETS_BY_PROJECT',
+                   'GAS_SPEND_BY_PROJECT')
+   ] + [
+     'ARBIGRANTS_ALL_%s_ACTIVE_WALLETS_ARBITRUM_ONE' % timeframe
+     for timeframe in TIMEFRAMES
+   ] + [
+     'ARBIGRANTS_ALL_MILESTONE_SUMMARY',
+     'ARBIGRANTS_LABELS_PROJECT_METADATA',
+     'ARBIGRANTS_LABELS_PROJECT_MILESTONES',
+     'ARBIGRANTS_LABELS_PROJECT_CONTRACTS',
+   ], REPLICA_DIR, REPLICA_REFRESH_INTERVAL, REPLICA_MAX_AGE,
+  data_changed_at)
+
+
+@app.cli.command('replica-sync')
+@click.option('--interval',
+              default=0,
+              help='Repeat the sync every N seconds instead of once.')
+def replica_sync_command(interval):
+  while True:
+    written = replica.sync()
+    if written is None:
+      click.echo('another process is syncing the replica')
+    else:
+      click.echo('snapshotted %d of %d tables' % (written, len(replica.tables)))
+    if not interval:
+      break
+    time.sleep(interval)
+
+
+async def execute_batch(queries, columnar=()):
+  # like execute_many, but the statements that miss the fragment cache are
+  # sent as a single multi-statement request. The queries named in columnar
+  # come back as Arrow tables rather than rows. Returns (results, stale),
+  # stale naming the queries the replica's outdated fallback answered.
+  statements = {
+    name: render_sql(sql_string, kwargs)
+    for name, (sql_string, kwargs) in queries.items()
+  }
+  results = {}
+  if FRAGMENT_CACHE_TTL:
+    version = await asyncio.to_thread(data_version)
+    keys = {
+      name: fragment_key(sql, params, version)
+      for name, (sql, params) in statements.items()
+    }
+    cached = await asyncio.to_thread(cache.get_many, *keys.values())
+    for name, rows in zip(keys, cached):
+      lookup = 'miss' if rows is None else 'hit'
+      FRAGMENT_LOOKUPS.labels(current_route(), name, lookup).inc()
+      if rows is not None:
+        results[name] = rows
+
+  missed = [name for name in statements if name not in results]
+  stale = set()
+  pending = missed
+  if pending and LOCAL_REPLICA:
+    local = await asyncio.to_thread(
+      lambda: {name: replica_rows(*statements[name], name,
+                                  arrow=name in columnar)
+               for name in pending})
+    results.update(
+      (name, rows) for name, rows in local.items() if rows is not None)
+    pending = [name for name in pending if name not in results]
+  if pending:
+    # qmark binds are positional across the whole request
+    batch = ';\n'.join(statements[name][0].strip() for name in pending)
+    params = [value for name in pending for value in statements[name][1]]
+    try:
+      result_sets = await query_warehouse_async(
+        batch, params, len(pending), 'batch',
+        [index for index, name in enumerate(pending) if name in columnar])
+    except Exception:
+      fallback = await asyncio.to_thread(
+        lambda: [warehouse_fallback(*statements[name], name,
+                                    arrow=name in columnar)
+                 for name in pending])
+      if any(rows is None for rows in fallback):
+        raise
+      result_sets = fallback
+      # the replica's stale answers stand in for this response only
+      stale.update(pending)
+    results.update(zip(pending, result_sets))
+  if missed and FRAGMENT_CACHE_TTL:
+    fresh = {
+      keys[name]: results[name]
+      for name in missed if name not in stale
+    }
+    if fresh:
+      await asyncio.to_thread(cache.set_many,
+                              fresh,
+                              timeout=FRAGMENT_CACHE_TTL)
+  return results, stale
+
+
+def stores_ready(frames):
+  # every frame is asked, so the cold ones all start loading at once
+  return all([aggregate_store.ready(name, timeframe)
+              for name, timeframe in frames])
+
+
+def aggregate_overview(timeframe, start_month, excludes, accounts_total):
+  # rebuilds tvl_query, accounts_chart and tvl_pie of the excludes branch
+  # from the local aggregate store
+  today = date.today()
+  tvl = aggregate_store.frame('tvl', timeframe).series(['TVL', 'TVL_ETH'],
+                                                       excludes,
+                                                       start=start_month,
+                                                       end=today)
+  wallets = aggregate_store.frame('wallets', timeframe).series(
+    ['ACTIVE_WALLETS'],
+    excludes,
+    start=start_month,
+    end=period_start(timeframe, today),
+    casts={'ACTIVE_WALLETS': int})
+  accounts_chart = accounts_total + [
+    dict(row, CATEGORY='grantees') for row in wallets
+  ]
+  accounts_chart.sort(key=lambda row: str(row["DATE"]))
+
+  names, values = aggregate_store.frame('tvl', 'day').snapshot(
+    'TVL', today - timedelta(days=1), excludes)
+
+  return {
+    "tvl_query": [dict(row, CATEGORY='grantees') for row in tvl],
+    "accounts_chart": accounts_chart,
+    "tvl_pie": top_share(names, values, 'TVL', 'PCT_TVL'),
+  }
 
-    # tvl_pct_stat = [{"PCT_TVL": cards_query[0]["PCT_TVL"]}]
 
-    gas_stat = [{"GAS_SPEND": cards_query[0]["GAS_SPEND"]}]
+def grant_day(grant_date):
+  # same fallback as the post-grant queries: MM/DD/YYYY, else 2023-03-01
+  try:
+    return datetime.strptime(grant_date or '', '%m/%d/%Y').date()
+  except ValueError:
+    return date(2023, 3, 1)
 
-    gas_pct_stat = [{"PCT_GAS_SPEND": cards_query[0]["PCT_GAS_SPEND"]}]
 
-    tvl_chart = execute_sql('''
-    SELECT DATE, 'grantees' AS CATEGORY, TVL FROM ARBIGRANTS.DBT.ARBIGRANTS_{chain}_{time}_TVL
-    WHERE DATE >= '{start_month}'
-    ORDER BY DATE
-    ''',
-                            time=timeframe,
-                            start_month=start_month,
-                            chain=chain)
-
-    tvl_chart_eth = execute_sql('''
-    SELECT DATE, 'grantees' AS CATEGORY, TVL_ETH FROM ARBIGRANTS.DBT.ARBIGRANTS_{chain}_{time}_TVL
-    WHERE DATE >= '{start_month}'
-    ORDER BY DATE
-    ''',
-                                time=timeframe,
-                                start_month=start_month,
-                                chain=chain)
+def sketch_overview(timeframe, start_month, excludes, cards_tvl, grant_dates):
+  # rebuilds cards_query, accounts_chart_post_grant and accounts_pie of the
+  # excludes branch from the wallet sketches and daily gas sums
+  today = date.today()
+  if timeframe == 'week':
+    window_start = today - timedelta(days=7)
+  elif timeframe == 'month':
+    window_start = today - relativedelta(months=1)
+  else:
+    window_start = today - timedelta(days=1)
+
+  wallets = aggregate_store.frame('wallet_sketch', 'day')
+  active_wallets = wallets.distinct(excludes, window_start, today)
+  all_wallets = aggregate_store.frame('all_wallet_sketch',
+                                      'day').distinct((), window_start, today)
+  gas_spend = aggregate_store.frame('gas', 'day').total('GAS_SPEND', excludes,
+                                                        window_start, today)
+  all_gas_spend = aggregate_store.frame('all_gas', 'day').total(
+    'GAS_SPEND', (), window_start, today)
+
+  cards_query = [{
+    "ACTIVE_WALLETS": round(active_wallets),
+    "PCT_WALLETS": active_wallets / all_wallets if all_wallets else None,
+    "GAS_SPEND": gas_spend,
+    "PCT_GAS_SPEND": gas_spend / all_gas_spend if all_gas_spend else None,
+    "TVL_GRANTEES": cards_tvl[0]["TVL_GRANTEES"],
+  }]
+
+  floors = {row["NAME"]: grant_day(row["GRANT_DATE"]) for row in grant_dates}
+  periods, counts = wallets.distinct_by_period(timeframe, excludes,
+                                               start_month,
+                                               period_start(timeframe, today),
+                                               floors)
+  accounts_chart_post_grant = [{
+    "DATE": str(period),
+    "ACTIVE_WALLETS": round(count)
+  } for period, count in zip(periods, counts)]
+
+  names, counts = wallets.distinct_by_name(excludes, window_start, today)
+  accounts_pie = top_share(names, counts.round(), 'ACTIVE_WALLETS',
+                           'PCT_WALLETS', cast=int)
+
+  return {
+    "cards_query": cards_query,
+    "accounts_chart_post_grant": accounts_chart_post_grant,
+    "accounts_pie": accounts_pie,
+  }
 
-    tvl_chart_post_grant = execute_sql('''
-    SELECT DATE, TVL 
-    FROM ARBIGRANTS.DBT.ARBIGRANTS_{chain}_{time}_TVL_POST_GRANT
-    WHERE DATE >= '{start_month}'
+
+def overview_series_queries(chain, timeframe):
+  # the default /overview's time series over their whole history; each
+  # timescale is a window of the same rows
+  return {
+    "tvl_query": ('''
+    SELECT DATE, 'grantees' AS CATEGORY, TVL, TVL_ETH FROM ARBIGRANTS.DBT.ARBIGRANTS_{chain}_{time}_TVL
     ORDER BY DATE
-    ''',
-                                       time=timeframe,
-                                       start_month=start_month,
-                                       chain=chain)
+    ''', dict(time=timeframe, chain=chain)),
 
-    tvl_chart_eth_post_grant = execute_sql('''
-    SELECT DATE, TVL_ETH
+    "tvl_post_grant_query": ('''
+    SELECT DATE, TVL, TVL_ETH
     FROM ARBIGRANTS.DBT.ARBIGRANTS_{chain}_{time}_TVL_POST_GRANT
-    WHERE DATE >= '{start_month}'
     ORDER BY DATE
-    ''',
-                                           time=timeframe,
-                                           start_month=start_month,
-                                           chain=chain)
+    ''', dict(time=timeframe, chain=chain)),
 
-    accounts_chart = execute_sql('''
+    "accounts_chart": ('''
     SELECT DATE, 'total' AS CATEGORY, ACTIVE_WALLETS FROM ARBIGRANTS.DBT.ARBIGRANTS_ALL_{time}_ACTIVE_WALLETS_ARBITRUM_ONE
-    WHERE DATE >= '{start_month}'
     UNION ALL
     SELECT DATE, 'grantees' AS CATEGORY, ACTIVE_WALLETS FROM ARBIGRANTS.DBT.ARBIGRANTS_{chain}_{time}_ACTIVE_WALLETS
-    WHERE DATE >= '{start_month}'
     ORDER BY DATE 
-    ''',
-                                 time=timeframe,
-                                 start_month=start_month,
-                                 chain=chain)
+    ''', dict(time=timeframe, chain=chain)),
 
-    accounts_chart_post_grant = execute_sql('''
+    "accounts_chart_post_grant": ('''
     SELECT * FROM ARBIGRANTS.DBT.ARBIGRANTS_{chain}_{time}_ACTIVE_WALLETS_POST_GRANT
-    WHERE DATE >= '{start_month}'
     ORDER BY DATE 
-    ''',
-                                            time=timeframe,
-                                            start_month=start_month,
-                                            chain=chain)
-
-    tvl_pie = execute_sql('''
-    SELECT * FROM ARBIGRANTS.DBT.ARBIGRANTS_{chain}_TVL_PIE
-    ''',
-                          chain=chain)
-
-    accounts_pie = execute_sql('''
-    SELECT * FROM ARBIGRANTS.DBT.ARBIGRANTS_{chain}_{time}_WALLETS_PIE
-    ''',
-                               time=timeframe,
-                               chain=chain)
-
-    leaderboard = execute_sql('''
-    SELECT * FROM ARBIGRANTS.DBT.ARBIGRANTS_{chain}_{time}_LEADERBOARD
-    ORDER BY WALLETS DESC
-    ''',
-                              time=timeframe,
-                              chain=chain)
-
-    milestones = execute_sql('''
-    SELECT * FROM ARBIGRANTS.DBT.ARBIGRANTS_ALL_MILESTONE_SUMMARY
-    ''')
-
-    name_list = execute_sql('''
-    SELECT NAME FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA
-    ''')
+    ''', dict(time=timeframe, chain=chain)),
+  }
+
+
+# (chain, timeframe) -> (data version, {name: SortedSeries}) for this worker
+series_cache = {}
+series_cache_lock = threading.Lock()
+
+
+def cached_series(chain, timeframe, version):
+  with series_cache_lock:
+    cached = series_cache.get((chain, timeframe))
+  if cached is None or version is None or cached[0] != version:
+    return None
+  return cached[1]
+
+
+def store_series(chain, timeframe, version, results, stale=()):
+  series = {
+    name: SortedSeries(results.pop(name))
+    for name in overview_series_queries(chain, timeframe)
+  }
+  # without a version nothing would tell when they go stale, and the
+  # replica's fallback is only good for the response it stood in for
+  if version is not None and not stale & series.keys():
+    with series_cache_lock:
+      series_cache[(chain, timeframe)] = (version, series)
+  return series
+
+
+@app.route('/overview')
+@swr_cached
+async def overview():
+  params = request_params()
+  timeframe = params['timeframe']
+  timescale = int(params['timescale'])
+  chain = params['chain']
+  since = parse_since(params['since'])
+
+  excludes = params['excludes']
+
+  current_date = datetime.now()
+  previous_month = current_date.replace(day=1) - relativedelta(
+    months=timescale)
+  start_month = previous_month.strftime('%Y-%m-%d')
+  # the sketches only reach HLL_HISTORY_DAYS back; longer windows are exact
+  use_sketches = HLL_SKETCHES and params['exact'] != '1' and (
+    current_date - previous_month).days <= HLL_HISTORY_DAYS
+
+  if not excludes:
+    version = await asyncio.to_thread(data_version)
+    series = cached_series(chain, timeframe, version)
+    # every statement here reads a small precomputed table, so they go to
+    # Snowflake together as one multi-statement request
+    queries = {
+      "cards_query": ('''
+      SELECT {time}_ACTIVE_WALLETS AS ACTIVE_WALLETS,
+      PCT_{time}_ACTIVE_WALLETS AS PCT_WALLETS,
+      TVL_GRANTEES,
+      {time}_GAS_SPEND AS GAS_SPEND,
+      PCT_{time}_GAS_SPEND AS PCT_GAS_SPEND
+      FROM ARBIGRANTS.DBT.ARBIGRANTS_{chain}_SUMMARY
+   ''', dict(time=timeframe, chain=chain)),
+
+      "tvl_pie": ('''
+      SELECT * FROM ARBIGRANTS.DBT.ARBIGRANTS_{chain}_TVL_PIE
+      ''', dict(chain=chain)),
+
+      "accounts_pie": ('''
+      SELECT * FROM ARBIGRANTS.DBT.ARBIGRANTS_{chain}_{time}_WALLETS_PIE
+      ''', dict(time=timeframe, chain=chain)),
+
+      "leaderboard": ('''
+      SELECT * FROM ARBIGRANTS.DBT.ARBIGRANTS_{chain}_{time}_LEADERBOARD
+      ORDER BY WALLETS DESC
+      ''', dict(time=timeframe, chain=chain)),
+
+      "milestones": ('''
+      SELECT * FROM ARBIGRANTS.DBT.ARBIGRANTS_ALL_MILESTONE_SUMMARY
+      ''', {}),
+
+      "name_list": ('''
+      SELECT NAME FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA
+      ''', {}),
+    }
+    if series is None:
+      queries.update(overview_series_queries(chain, timeframe))
+    # the long series and the leaderboard are read column-wise, and only
+    # the rows a response needs become dicts
+    results, stale = await execute_batch(
+      queries, columnar=set(overview_series_queries(chain, timeframe))
+      | {"leaderboard"})
+    if series is None:
+      series = store_series(chain, timeframe, version, results, stale)
+    if stale:
+      # the payload is stored degraded, so it is rebuilt once the warehouse
+      # answers instead of being served as current
+      g.degraded = True
+    start = max(start_month, since) if since else start_month
+
+    cards_query = results["cards_query"]
+    tvl_query = series["tvl_query"]
+    tvl_post_grant_query = series["tvl_post_grant_query"]
+
+    tvl_chart = tvl_query.since(start, drop=['TVL_ETH'])
+    tvl_chart_eth = tvl_query.since(start, drop=['TVL'])
+    tvl_chart_post_grant = tvl_post_grant_query.since(start, drop=['TVL_ETH'])
+    tvl_chart_eth_post_grant = tvl_post_grant_query.since(start, drop=['TVL'])
+
+    wallets_stat = [{"ACTIVE_WALLETS": cards_query[0]["ACTIVE_WALLETS"]}]
+
+    wallets_pct_stat = [{"PCT_WALLETS": cards_query[0]["PCT_WALLETS"]}]
+
+    tvl_stat = [{"TVL_GRANTEES": cards_query[0]["TVL_GRANTEES"]}]
+
+    # tvl_pct_stat = [{"PCT_TVL": cards_query[0]["PCT_TVL"]}]
+
+    gas_stat = [{"GAS_SPEND": cards_query[0]["GAS_SPEND"]}]
+
+    gas_pct_stat = [{"PCT_GAS_SPEND": cards_query[0]["PCT_GAS_SPEND"]}]
 
     current_time = datetime.now().strftime('%d/%m/%y %H:%M')
 
@@ -186,20 +1778,29 @@ def overview():
       "gas_pct_stat": gas_pct_stat,
       "tvl_chart": tvl_chart,
       "tvl_chart_eth": tvl_chart_eth,
-      "accounts_chart": accounts_chart,
+      "accounts_chart": series["accounts_chart"].since(start),
       "tvl_chart_post_grant": tvl_chart_post_grant,
       "tvl_chart_eth_post_grant": tvl_chart_eth_post_grant,
-      "accounts_chart_post_grant": accounts_chart_post_grant,
-      "tvl_pie": tvl_pie,
-      "accounts_pie": accounts_pie,
-      "leaderboard": leaderboard,
-      "milestones": milestones,
-      "name_list": name_list,
+      "accounts_chart_post_grant":
+      series["accounts_chart_post_grant"].since(start),
+      "tvl_pie": results["tvl_pie"],
+      "accounts_pie": results["accounts_pie"],
+      "leaderboard": results["leaderboard"].to_pylist(),
+      "milestones": results["milestones"],
+      "name_list": results["name_list"],
     }
 
-    return jsonify(response_data)
+    return series_delta(response_data, since, OVERVIEW_CHARTS)
 
   else:
+    # a store that is cold or behind the data version loads in the
+    # background while this request takes the SQL path
+    use_aggregates = AGGREGATE_STORE and await asyncio.to_thread(
+      stores_ready, [('tvl', timeframe), ('wallets', timeframe),
+                     ('tvl', 'day')])
+    use_sketches = use_sketches and await asyncio.to_thread(
+      stores_ready, [('wallet_sketch', 'day'), ('all_wallet_sketch', 'day'),
+                     ('gas', 'day'), ('all_gas', 'day')])
 
     if timeframe == 'week':
       time_param = '7 day'
@@ -208,63 +1809,319 @@ def overview():
     else:
       time_param = '1 day'
 
-    cards_query = execute_sql('''
-    WITH stats_gen AS (
-    WITH all_txns AS (
-    SELECT 
-    COUNT(DISTINCT FROM_ADDRESS) as all_active_wallets,
-    SUM((RECEIPT_EFFECTIVE_GAS_PRICE * RECEIPT_GAS_USED)/1e18) AS all_gas_spend
-    FROM ARBITRUM.RAW.TRANSACTIONS t   
-    WHERE BLOCK_TIMESTAMP < CURRENT_DATE
-    AND BLOCK_TIMESTAMP >= CURRENT_DATE - interval '{time_param}'
-    ),
+    queries = {
+      "cards_query": ('''
+      WITH stats_gen AS (
+      WITH all_txns AS (
+      SELECT 
+      COUNT(DISTINCT FROM_ADDRESS) as all_active_wallets,
+      SUM((RECEIPT_EFFECTIVE_GAS_PRICE * RECEIPT_GAS_USED)/1e18) AS all_gas_spend
+      FROM ARBITRUM.RAW.TRANSACTIONS t   
+      WHERE BLOCK_TIMESTAMP < CURRENT_DATE
+      AND BLOCK_TIMESTAMP >= CURRENT_DATE - interval '{time_param}'
+      ),
     
-    grantee_txns AS (
-    SELECT 
-    COUNT(DISTINCT FROM_ADDRESS) as grantee_active_wallets,
-    SUM((RECEIPT_EFFECTIVE_GAS_PRICE * RECEIPT_GAS_USED)/1e18) AS grantee_gas_spend
-    FROM ARBITRUM.RAW.TRANSACTIONS t
-    INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_CONTRACTS c
-    ON c.CONTRACT_ADDRESS = t.TO_ADDRESS
-    AND BLOCK_TIMESTAMP < CURRENT_DATE
-    AND BLOCK_TIMESTAMP >= CURRENT_DATE - interval '{time_param}'
-    AND c.NAME NOT IN ({exclude_list})
-    INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA m
-    ON m.NAME = c.NAME 
-    AND m.chain = 'Arbitrum One'
-    )
+      grantee_txns AS (
+      SELECT 
+      COUNT(DISTINCT FROM_ADDRESS) as grantee_active_wallets,
+      SUM((RECEIPT_EFFECTIVE_GAS_PRICE * RECEIPT_GAS_USED)/1e18) AS grantee_gas_spend
+      FROM ARBITRUM.RAW.TRANSACTIONS t
+      INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_CONTRACTS c
+      ON c.CONTRACT_ADDRESS = t.TO_ADDRESS
+      AND BLOCK_TIMESTAMP < CURRENT_DATE
+      AND BLOCK_TIMESTAMP >= CURRENT_DATE - interval '{time_param}'
+      AND c.NAME NOT IN (:excludes)
+      INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA m
+      ON m.NAME = c.NAME 
+      AND m.chain = 'Arbitrum One'
+      )
     
-    SELECT 
-    grantee_active_wallets AS active_wallets,
-    grantee_active_wallets/all_active_wallets AS pct_wallets,
-    grantee_gas_spend as gas_spend,
-    grantee_gas_spend/all_gas_spend as pct_gas_spend
-    FROM all_txns, grantee_txns
-    ),
-
-    stats_tvl AS (
-    WITH grantee_tvl AS (
-    SELECT 
-    SUM(h.TOTAL_LIQUIDITY_USD) AS tvl_grantees
-    FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA m
-    INNER JOIN DEFILLAMA.TVL.HISTORICAL_TVL_PER_CHAIN h
-    ON h.CHAIN = 'Arbitrum'
-    AND date_trunc('day',h.NEAREST_DATE) = current_date
-    AND LLAMA_NAME != ''
-    AND h.PROTOCOL_NAME LIKE LLAMA_NAME || '%'
-    AND m.NAME NOT IN ({exclude_list})
-    AND m.CHAIN = 'Arbitrum One'
-    )
+      SELECT 
+      grantee_active_wallets AS active_wallets,
+      grantee_active_wallets/all_active_wallets AS pct_wallets,
+      grantee_gas_spend as gas_spend,
+      grantee_gas_spend/all_gas_spend as pct_gas_spend
+      FROM all_txns, grantee_txns
+      ),
+
+      stats_tvl AS (
+      WITH grantee_tvl AS (
+      SELECT 
+      SUM(h.TOTAL_LIQUIDITY_USD) AS tvl_grantees
+      FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA m
+      INNER JOIN DEFILLAMA.TVL.HISTORICAL_TVL_PER_CHAIN h
+      ON h.CHAIN = 'Arbitrum'
+      AND date_trunc('day',h.NEAREST_DATE) = current_date
+      AND LLAMA_NAME != ''
+      AND h.PROTOCOL_NAME LIKE LLAMA_NAME || '%'
+      AND m.NAME NOT IN (:excludes)
+      AND m.CHAIN = 'Arbitrum One'
+      )
     
-    SELECT 
-    tvl_grantees
-    FROM grantee_tvl
-    )
+      SELECT 
+      tvl_grantees
+      FROM grantee_tvl
+      )
 
-    SELECT * FROM stats_gen, stats_tvl
-    ''',
-                              time_param=time_param,
-                              exclude_list=exclude_list)
+      SELECT * FROM stats_gen, stats_tvl
+      ''', dict(time_param=time_param, excludes=excludes)),
+
+      "tvl_query": ('''
+      with grantees AS (
+      SELECT 
+      DATE,
+      'grantees' as category,
+      SUM(TVL) AS TVL,
+      SUM(TVL_ETH) AS TVL_ETH
+      FROM ARBIGRANTS.DBT.ARBIGRANTS_ONE_{time}_TVL_BY_PROJECT
+      WHERE NAME NOT IN (:excludes)
+      AND DATE < DATE_TRUNC('day',CURRENT_DATE())
+      AND DATE >= to_timestamp(:start_month, 'yyyy-MM-dd')
+      GROUP BY 1,2
+      )
+
+      SELECT * FROM grantees
+      ORDER BY DATE
+      ''', dict(time=timeframe, start_month=start_month, excludes=excludes)),
+
+      "accounts_chart": ('''
+      with total AS (
+      SELECT 
+      DATE,
+      'total' as category,
+      ACTIVE_WALLETS
+      FROM ARBIGRANTS.DBT.ARBIGRANTS_ALL_{time}_ACTIVE_WALLETS_ARBITRUM_ONE
+      WHERE DATE < DATE_TRUNC('{time}',CURRENT_DATE())
+      AND DATE >= to_timestamp(:start_month, 'yyyy-MM-dd')
+      )
+
+      , grantees AS (
+      SELECT 
+      DATE,
+      'grantees' as category,
+      SUM(ACTIVE_WALLETS) AS ACTIVE_WALLETS
+      FROM ARBIGRANTS.DBT.ARBIGRANTS_ONE_{time}_ACTIVE_WALLETS_BY_PROJECT
+      WHERE DATE < DATE_TRUNC('{time}',CURRENT_DATE())
+      AND DATE >= to_timestamp(:start_month, 'yyyy-MM-dd')
+      AND NAME NOT IN (:excludes)
+      GROUP BY 1,2
+      )
+
+      SELECT * FROM total
+      UNION ALL 
+      SELECT * FROM grantees
+      ORDER BY DATE
+      ''', dict(time=timeframe, start_month=start_month, excludes=excludes)),
+
+      "tvl_post_grant_query": ('''
+      with grantees AS (
+      SELECT 
+      TO_VARCHAR(DATE_TRUNC('{time}',DATE), 'YYYY-MM-DD') AS date,
+      SUM(TVL) AS TVL
+      FROM 
+      (
+          SELECT
+          DATE,
+          m.GRANT_DATE,
+          h.TOTAL_LIQUIDITY_USD AS TVL,
+          ROW_NUMBER() OVER (PARTITION BY h.PROTOCOL_NAME, DATE ORDER BY h.NEAREST_DATE DESC) AS rn
+          FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA m
+          INNER JOIN DEFILLAMA.TVL.HISTORICAL_TVL_PER_CHAIN h
+          ON h.CHAIN = 'Arbitrum'
+          AND LLAMA_NAME != ''
+          AND h.PROTOCOL_NAME LIKE LLAMA_NAME || '%'
+          AND DATE < DATE_TRUNC('{time}',CURRENT_DATE())
+          AND DATE >= to_timestamp(:start_month, 'yyyy-MM-dd')
+          AND m.CHAIN = 'Arbitrum One'
+          AND m.NAME NOT IN (:excludes)
+      )
+      WHERE DATE >= CASE
+          WHEN TRY_TO_TIMESTAMP(GRANT_DATE, 'MM/DD/YYYY') IS NOT NULL THEN TRY_TO_TIMESTAMP(GRANT_DATE, 'MM/DD/YYYY')
+          ELSE TO_TIMESTAMP('2023-03-01', 'YYYY-MM-DD')
+      END
+      AND rn = 1
+      GROUP BY 1
+      )
+
+      , prices AS (
+      SELECT 
+      DATE_TRUNC('{time}',HOUR) AS date,
+      LAST_VALUE(USD_PRICE) OVER (PARTITION BY DATE_TRUNC('{time}', HOUR) ORDER BY HOUR) AS USD_PRICE
+      FROM COMMON.PRICES.TOKEN_PRICES_HOURLY_EASY
+      WHERE SYMBOL = 'ETH'
+      AND ETHEREUM_ADDRESS = '0x0000000000000000000000000000000000000000'
+      AND HOUR >= to_timestamp(:start_month, 'yyyy-MM-dd')
+      QUALIFY ROW_NUMBER() OVER (PARTITION BY DATE_TRUNC('{time}', HOUR) ORDER BY HOUR DESC) = 1
+      )
+
+      SELECT 
+      m.DATE,
+      m.TVL,
+      m.TVL/p.USD_PRICE AS TVL_ETH
+      FROM grantees m
+      LEFT JOIN prices p
+      ON m.DATE = p.DATE
+      ''', dict(time=timeframe, excludes=excludes, start_month=start_month)),
+
+      "accounts_chart_post_grant": ('''
+      SELECT 
+      TO_VARCHAR(DATE_TRUNC('{time}',BLOCK_TIMESTAMP), 'YYYY-MM-DD') AS date,
+      COUNT(DISTINCT FROM_ADDRESS) AS active_wallets
+      FROM ARBITRUM.RAW.TRANSACTIONS t
+      INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_CONTRACTS c
+      ON c.CONTRACT_ADDRESS = t.TO_ADDRESS
+      AND BLOCK_TIMESTAMP < DATE_TRUNC('{time}',CURRENT_DATE())
+      AND BLOCK_TIMESTAMP >= to_timestamp(:start_month, 'yyyy-MM-dd')
+      INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA m
+      ON c.NAME = m.NAME
+      AND t.BLOCK_TIMESTAMP >= CASE
+          WHEN TRY_TO_TIMESTAMP(m.GRANT_DATE, 'MM/DD/YYYY') IS NOT NULL THEN TRY_TO_TIMESTAMP(m.GRANT_DATE, 'MM/DD/YYYY')
+          ELSE TO_TIMESTAMP('2023-03-01', 'YYYY-MM-DD')
+      END
+      AND m.CHAIN = 'Arbitrum One'
+      AND m.NAME NOT IN (:excludes)
+      GROUP BY 1
+      ''', dict(time=timeframe, excludes=excludes, start_month=start_month)),
+
+      "tvl_pie": ('''
+      WITH cte AS (
+        SELECT 
+          NAME,
+          TVL,
+          SUM(TVL) OVER () AS TOTAL_TVL
+        FROM ARBIGRANTS.DBT.ARBIGRANTS_ONE_DAY_TVL_BY_PROJECT
+        WHERE DATE = TO_VARCHAR(DATE_TRUNC('day',CURRENT_DATE - INTERVAL '1 DAY'), 'YYYY-MM-DD')
+        AND NAME NOT IN (:excludes)
+      ),
+      ranked_cte AS (
+        SELECT 
+          NAME,
+          TVL,
+          TOTAL_TVL,
+          ROUND(TVL / TOTAL_TVL * 100, 2) AS PCT_TVL,
+          RANK() OVER (ORDER BY TVL DESC) AS rnk
+        FROM cte
+      )
+      SELECT 
+        CASE WHEN rnk <= 5 THEN NAME ELSE 'Other' END AS NAME,
+        SUM(TVL) AS TVL,
+        ROUND(SUM(TVL) / MAX(TOTAL_TVL) * 100, 2) AS PCT_TVL
+      FROM ranked_cte
+      GROUP BY CASE WHEN rnk <= 5 THEN NAME ELSE 'Other' END
+      ORDER BY TVL DESC
+      ''', dict(excludes=excludes)),
+
+      "accounts_pie": ('''
+      WITH cte AS (
+      SELECT 
+      c.NAME,
+      COUNT(DISTINCT FROM_ADDRESS) AS active_wallets,
+      SUM(COUNT(DISTINCT FROM_ADDRESS)) OVER () AS total_wallets
+      FROM ARBITRUM.RAW.TRANSACTIONS t
+      INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_CONTRACTS c
+      ON c.CONTRACT_ADDRESS = t.TO_ADDRESS
+      AND BLOCK_TIMESTAMP < CURRENT_DATE
+      AND BLOCK_TIMESTAMP >= CURRENT_DATE - interval '{time_param}'
+      AND C.NAME NOT IN (:excludes)
+      INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA m
+      ON m.NAME = c.NAME
+      AND m.CHAIN = 'Arbitrum One'
+      GROUP BY 1
+      ),
+      ranked_cte AS (
+        SELECT 
+          NAME,
+          active_wallets,
+          total_wallets,
+          ROUND(active_wallets / total_wallets * 100, 2) AS PCT_TVL,
+          RANK() OVER (ORDER BY active_wallets DESC) AS rnk
+        FROM cte
+      )
+      SELECT 
+        CASE WHEN rnk <= 5 THEN NAME ELSE 'Other' END AS NAME,
+        SUM(active_wallets) AS active_wallets,
+        ROUND(SUM(active_wallets) / MAX(total_wallets) * 100, 2) AS PCT_WALLETS
+      FROM ranked_cte
+      GROUP BY CASE WHEN rnk <= 5 THEN NAME ELSE 'Other' END
+      ORDER BY active_wallets DESC
+      ''', dict(time_param=time_param, time=timeframe, excludes=excludes)),
+
+      "leaderboard": ('''
+      SELECT * FROM ARBIGRANTS.DBT.ARBIGRANTS_ONE_{time}_LEADERBOARD
+      ORDER BY WALLETS DESC
+      ''', dict(time=timeframe)),
+
+      "milestones": ('''
+      SELECT * FROM ARBIGRANTS.DBT.ARBIGRANTS_ALL_MILESTONE_SUMMARY
+      ''', {}),
+
+      "name_list": ('''
+      SELECT NAME FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA
+      ''', {}),
+    }
+
+    if use_aggregates:
+      # the additive per-project series come from the local store instead;
+      # only the all-chain wallet totals still need the warehouse
+      for name in ("tvl_query", "accounts_chart", "tvl_pie"):
+        del queries[name]
+      queries["accounts_total"] = ('''
+      SELECT 
+      DATE,
+      'total' as category,
+      ACTIVE_WALLETS
+      FROM ARBIGRANTS.DBT.ARBIGRANTS_ALL_{time}_ACTIVE_WALLETS_ARBITRUM_ONE
+      WHERE DATE < DATE_TRUNC('{time}',CURRENT_DATE())
+      AND DATE >= to_timestamp(:start_month, 'yyyy-MM-dd')
+      ''', dict(time=timeframe, start_month=start_month))
+
+    if use_sketches:
+      # distinct wallets and gas come from the sketch store; the warehouse
+      # only supplies the DefiLlama TVL card and grant dates
+      for name in ("cards_query", "accounts_chart_post_grant", "accounts_pie"):
+        del queries[name]
+      queries["cards_tvl"] = ('''
+      SELECT 
+      SUM(h.TOTAL_LIQUIDITY_USD) AS TVL_GRANTEES
+      FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA m
+      INNER JOIN DEFILLAMA.TVL.HISTORICAL_TVL_PER_CHAIN h
+      ON h.CHAIN = 'Arbitrum'
+      AND date_trunc('day',h.NEAREST_DATE) = current_date
+      AND LLAMA_NAME != ''
+      AND h.PROTOCOL_NAME LIKE LLAMA_NAME || '%'
+      AND m.NAME NOT IN (:excludes)
+      AND m.CHAIN = 'Arbitrum One'
+      ''', dict(excludes=excludes))
+      queries["grant_dates"] = ('''
+      SELECT NAME, GRANT_DATE
+      FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA
+      WHERE CHAIN = 'Arbitrum One'
+      ''', {})
+
+    # whatever still scans the raw transactions is slow by design
+    results = await execute_many(
+      queries,
+      heavy={"cards_query", "accounts_chart_post_grant", "accounts_pie"})
+    # the local stores may load or refresh from disk, so they stay off the
+    # event loop
+    if use_aggregates:
+      results.update(await asyncio.to_thread(aggregate_overview, timeframe,
+                                             start_month, excludes,
+                                             results.pop("accounts_total")))
+    if use_sketches:
+      results.update(await asyncio.to_thread(sketch_overview, timeframe,
+                                             start_month, excludes,
+                                             results.pop("cards_tvl"),
+                                             results.pop("grant_dates")))
+
+    cards_query = results["cards_query"]
+    tvl_query = results["tvl_query"]
+    tvl_post_grant_query = results["tvl_post_grant_query"]
+
+    tvl_chart = drop_column(tvl_query, 'TVL_ETH')
+    tvl_chart_eth = drop_column(tvl_query, 'TVL')
+    tvl_chart_post_grant = drop_column(tvl_post_grant_query, 'TVL_ETH')
+    tvl_chart_eth_post_grant = drop_column(tvl_post_grant_query, 'TVL')
 
     wallets_stat = [{"ACTIVE_WALLETS": cards_query[0]["ACTIVE_WALLETS"]}]
 
@@ -278,234 +2135,6 @@ def overview():
 
     gas_pct_stat = [{"PCT_GAS_SPEND": cards_query[0]["PCT_GAS_SPEND"]}]
 
-    tvl_query = execute_sql('''
-    with grantees AS (
-    SELECT 
-    DATE,
-    'grantees' as category,
-    SUM(TVL) AS TVL,
-    SUM(TVL_ETH) AS TVL_ETH
-    FROM ARBIGRANTS.DBT.ARBIGRANTS_ONE_{time}_TVL_BY_PROJECT
-    WHERE NAME NOT IN ({exclude_list})
-    AND DATE < DATE_TRUNC('day',CURRENT_DATE())
-    AND DATE >= to_timestamp('{start_month}', 'yyyy-MM-dd')
-    GROUP BY 1,2
-    )
-
-    SELECT * FROM grantees
-    ORDER BY DATE
-    ''',
-                            time=timeframe,
-                            start_month=start_month,
-                            exclude_list=exclude_list)
-
-    tvl_chart = [{
-      k: v
-      for k, v in item.items() if k != 'TVL_ETH'
-    } for item in tvl_query]
-    tvl_chart_eth = [{
-      k: v
-      for k, v in item.items() if k != 'TVL'
-    } for item in tvl_query]
-
-    accounts_chart = execute_sql('''
-    with total AS (
-    SELECT 
-    DATE,
-    'total' as category,
-    ACTIVE_WALLETS
-    FROM ARBIGRANTS.DBT.ARBIGRANTS_ALL_{time}_ACTIVE_WALLETS_ARBITRUM_ONE
-    WHERE DATE < DATE_TRUNC('{time}',CURRENT_DATE())
-    AND DATE >= to_timestamp('{start_month}', 'yyyy-MM-dd')
-    )
-
-    , grantees AS (
-    SELECT 
-    DATE,
-    'grantees' as category,
-    SUM(ACTIVE_WALLETS) AS ACTIVE_WALLETS
-    FROM ARBIGRANTS.DBT.ARBIGRANTS_ONE_{time}_ACTIVE_WALLETS_BY_PROJECT
-    WHERE DATE < DATE_TRUNC('{time}',CURRENT_DATE())
-    AND DATE >= to_timestamp('{start_month}', 'yyyy-MM-dd')
-    AND NAME NOT IN ({exclude_list})
-    GROUP BY 1,2
-    )
-
-    SELECT * FROM total
-    UNION ALL 
-    SELECT * FROM grantees
-    ORDER BY DATE
-    ''',
-                                 time=timeframe,
-                                 start_month=start_month,
-                                 exclude_list=exclude_list)
-
-    tvl_post_grant_query = execute_sql('''
-    with grantees AS (
-    SELECT 
-    TO_VARCHAR(DATE_TRUNC('{time}',DATE), 'YYYY-MM-DD') AS date,
-    SUM(TVL) AS TVL
-    FROM 
-    (
-        SELECT
-        DATE,
-        m.GRANT_DATE,
-        h.TOTAL_LIQUIDITY_USD AS TVL,
-        ROW_NUMBER() OVER (PARTITION BY h.PROTOCOL_NAME, DATE ORDER BY h.NEAREST_DATE DESC) AS rn
-        FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA m
-        INNER JOIN DEFILLAMA.TVL.HISTORICAL_TVL_PER_CHAIN h
-        ON h.CHAIN = 'Arbitrum'
-        AND LLAMA_NAME != ''
-        AND h.PROTOCOL_NAME LIKE LLAMA_NAME || '%'
-        AND DATE < DATE_TRUNC('{time}',CURRENT_DATE())
-        AND DATE >= to_timestamp('{start_month}', 'yyyy-MM-dd')
-        AND m.CHAIN = 'Arbitrum One'
-        AND m.NAME NOT IN ({exclude_list})
-    )
-    WHERE DATE >= CASE
-        WHEN TRY_TO_TIMESTAMP(GRANT_DATE, 'MM/DD/YYYY') IS NOT NULL THEN TRY_TO_TIMESTAMP(GRANT_DATE, 'MM/DD/YYYY')
-        ELSE TO_TIMESTAMP('2023-03-01', 'YYYY-MM-DD')
-    END
-    AND rn = 1
-    GROUP BY 1
-    )
-
-    , prices AS (
-    SELECT 
-    DATE_TRUNC('{time}',HOUR) AS date,
-    LAST_VALUE(USD_PRICE) OVER (PARTITION BY DATE_TRUNC('{time}', HOUR) ORDER BY HOUR) AS USD_PRICE
-    FROM COMMON.PRICES.TOKEN_PRICES_HOURLY_EASY
-    WHERE SYMBOL = 'ETH'
-    AND ETHEREUM_ADDRESS = '0x0000000000000000000000000000000000000000'
-    AND HOUR >= to_timestamp('{start_month}', 'yyyy-MM-dd')
-    QUALIFY ROW_NUMBER() OVER (PARTITION BY DATE_TRUNC('{time}', HOUR) ORDER BY HOUR DESC) = 1
-    )
-
-    SELECT 
-    m.DATE,
-    m.TVL,
-    m.TVL/p.USD_PRICE AS TVL_ETH
-    FROM grantees m
-    LEFT JOIN prices p
-    ON m.DATE = p.DATE
-    ''',
-                                       time=timeframe,
-                                       exclude_list=exclude_list,
-                                       start_month=start_month)
-
-    tvl_chart_post_grant = [{
-      k: v
-      for k, v in item.items() if k != 'TVL_ETH'
-    } for item in tvl_post_grant_query]
-    tvl_chart_eth_post_grant = [{
-      k: v
-      for k, v in item.items() if k != 'TVL'
-    } for item in tvl_post_grant_query]
-
-    accounts_chart_post_grant = execute_sql('''
-    SELECT 
-    TO_VARCHAR(DATE_TRUNC('{time}',BLOCK_TIMESTAMP), 'YYYY-MM-DD') AS date,
-    COUNT(DISTINCT FROM_ADDRESS) AS active_wallets
-    FROM ARBITRUM.RAW.TRANSACTIONS t
-    INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_CONTRACTS c
-    ON c.CONTRACT_ADDRESS = t.TO_ADDRESS
-    AND BLOCK_TIMESTAMP < DATE_TRUNC('{time}',CURRENT_DATE())
-    AND BLOCK_TIMESTAMP >= to_timestamp('{start_month}', 'yyyy-MM-dd')
-    INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA m
-    ON c.NAME = m.NAME
-    AND t.BLOCK_TIMESTAMP >= CASE
-        WHEN TRY_TO_TIMESTAMP(m.GRANT_DATE, 'MM/DD/YYYY') IS NOT NULL THEN TRY_TO_TIMESTAMP(m.GRANT_DATE, 'MM/DD/YYYY')
-        ELSE TO_TIMESTAMP('2023-03-01', 'YYYY-MM-DD')
-    END
-    AND m.CHAIN = 'Arbitrum One'
-    AND m.NAME NOT IN ({exclude_list})
-    GROUP BY 1
-    ''',
-                                            time=timeframe,
-                                            exclude_list=exclude_list,
-                                            start_month=start_month)
-
-    tvl_pie = execute_sql('''
-    WITH cte AS (
-      SELECT 
-        NAME,
-        TVL,
-        SUM(TVL) OVER () AS TOTAL_TVL
-      FROM ARBIGRANTS.DBT.ARBIGRANTS_ONE_DAY_TVL_BY_PROJECT
-      WHERE DATE = TO_VARCHAR(DATE_TRUNC('day',CURRENT_DATE - INTERVAL '1 DAY'), 'YYYY-MM-DD')
-      AND NAME NOT IN ({exclude_list})
-    ),
-    ranked_cte AS (
-      SELECT 
-        NAME,
-        TVL,
-        TOTAL_TVL,
-        ROUND(TVL / TOTAL_TVL * 100, 2) AS PCT_TVL,
-        RANK() OVER (ORDER BY TVL DESC) AS rnk
-      FROM cte
-    )
-    SELECT 
-      CASE WHEN rnk <= 5 THEN NAME ELSE 'Other' END AS NAME,
-      SUM(TVL) AS TVL,
-      ROUND(SUM(TVL) / MAX(TOTAL_TVL) * 100, 2) AS PCT_TVL
-    FROM ranked_cte
-    GROUP BY CASE WHEN rnk <= 5 THEN NAME ELSE 'Other' END
-    ORDER BY TVL DESC
-    ''',
-                          exclude_list=exclude_list)
-
-    accounts_pie = execute_sql('''
-    WITH cte AS (
-    SELECT 
-    c.NAME,
-    COUNT(DISTINCT FROM_ADDRESS) AS active_wallets,
-    SUM(COUNT(DISTINCT FROM_ADDRESS)) OVER () AS total_wallets
-    FROM ARBITRUM.RAW.TRANSACTIONS t
-    INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_CONTRACTS c
-    ON c.CONTRACT_ADDRESS = t.TO_ADDRESS
-    AND BLOCK_TIMESTAMP < CURRENT_DATE
-    AND BLOCK_TIMESTAMP >= CURRENT_DATE - interval '{time_param}'
-    AND C.NAME NOT IN ({exclude_list})
-    INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA m
-    ON m.NAME = c.NAME
-    AND m.CHAIN = 'Arbitrum One'
-    GROUP BY 1
-    ),
-    ranked_cte AS (
-      SELECT 
-        NAME,
-        active_wallets,
-        total_wallets,
-        ROUND(active_wallets / total_wallets * 100, 2) AS PCT_TVL,
-        RANK() OVER (ORDER BY active_wallets DESC) AS rnk
-      FROM cte
-    )
-    SELECT 
-      CASE WHEN rnk <= 5 THEN NAME ELSE 'Other' END AS NAME,
-      SUM(active_wallets) AS active_wallets,
-      ROUND(SUM(active_wallets) / MAX(total_wallets) * 100, 2) AS PCT_WALLETS
-    FROM ranked_cte
-    GROUP BY CASE WHEN rnk <= 5 THEN NAME ELSE 'Other' END
-    ORDER BY active_wallets DESC
-    ''',
-                               time_param=time_param,
-                               time=timeframe,
-                               exclude_list=exclude_list)
-
-    leaderboard = execute_sql('''
-    SELECT * FROM ARBIGRANTS.DBT.ARBIGRANTS_ONE_{time}_LEADERBOARD
-    ORDER BY WALLETS DESC
-    ''',
-                              time=timeframe)
-
-    milestones = execute_sql('''
-    SELECT * FROM ARBIGRANTS.DBT.ARBIGRANTS_ALL_MILESTONE_SUMMARY
-    ''')
-
-    name_list = execute_sql('''
-    SELECT NAME FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA
-    ''')
-
     current_time = datetime.now().strftime('%d/%m/%y %H:%M')
 
     response_data = {
@@ -518,149 +2147,238 @@ def overview():
       "gas_pct_stat": gas_pct_stat,
       "tvl_chart": tvl_chart,
       "tvl_chart_eth": tvl_chart_eth,
-      "accounts_chart": accounts_chart,
+      "accounts_chart": results["accounts_chart"],
       "tvl_chart_post_grant": tvl_chart_post_grant,
       "tvl_chart_eth_post_grant": tvl_chart_eth_post_grant,
-      "accounts_chart_post_grant": accounts_chart_post_grant,
-      "tvl_pie": tvl_pie,
-      "accounts_pie": accounts_pie,
-      "leaderboard": leaderboard,
-      "milestones": milestones,
-      "name_list": name_list,
+      "accounts_chart_post_grant": results["accounts_chart_post_grant"],
+      "tvl_pie": results["tvl_pie"],
+      "accounts_pie": results["accounts_pie"],
+      "leaderboard": results["leaderboard"],
+      "milestones": results["milestones"],
+      "name_list": results["name_list"],
     }
 
-    return jsonify(response_data)
-
-
-@app.route('/grantee')
-@cache.memoize(make_name=make_cache_key)
-def entity():
-  timeframe = request.args.get('timeframe', 'week')
-  grantee_name = request.args.get('grantee_name', 'pendle')
-
-  info = execute_sql('''
-  SELECT 
-  NAME,
-  LOGO,
-  DESCRIPTION,
-  WEBSITE,
-  TWITTER,
-  DUNE
-  FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA
-  WHERE NAME = '{grantee_name}'
-  ''',
-                     grantee_name=grantee_name)
+    return series_delta(response_data, since, OVERVIEW_CHARTS)
 
-  wallets_chart = execute_sql('''
-  SELECT 
-  DATE,
-  ACTIVE_WALLETS
-  FROM ARBIGRANTS.DBT.ARBIGRANTS_ALL_{time}_ACTIVE_WALLETS_BY_PROJECT
-  WHERE NAME = '{grantee_name}'
-  ORDER BY 1
-  ''',
-                              time=timeframe,
-                              grantee_name=grantee_name)
 
-  gas_chart = execute_sql('''
-  SELECT 
-  DATE,
-  GAS_SPEND
-  FROM ARBIGRANTS.DBT.ARBIGRANTS_ALL_{time}_GAS_SPEND_BY_PROJECT
-  WHERE NAME = '{grantee_name}'
-  ORDER BY 1
-  ''',
-                          time=timeframe,
-                          grantee_name=grantee_name)
+def grantee_queries(timeframe, names, sections):
+  # one statement per section covering every name; rows carry NAME so they
+  # can be split per grantee
+  queries = {
+    "metadata": ('''
+    SELECT 
+    NAME,
+    LOGO,
+    DESCRIPTION,
+    WEBSITE,
+    TWITTER,
+    DUNE,
+    LLAMA_NAME,
+    GRANT_DATE
+    FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA
+    WHERE LOWER(NAME) IN (:lower_names)
+    ''', dict(lower_names=[name.lower() for name in names])),
 
-  txns_chart = execute_sql('''
-  SELECT 
-  TO_VARCHAR(DATE_TRUNC('{time}',BLOCK_TIMESTAMP), 'YYYY-MM-DD') AS date,
-  COUNT(*) AS transactions
-  FROM ARBITRUM.RAW.TRANSACTIONS t
-  INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_CONTRACTS c
-  ON c.CONTRACT_ADDRESS = t.TO_ADDRESS
-  AND t.BLOCK_TIMESTAMP < DATE_TRUNC('{time}',CURRENT_DATE())
-  AND t.BLOCK_TIMESTAMP >= to_timestamp('2023-06-01', 'yyyy-MM-dd')
-  AND c.NAME = '{grantee_name}'
-  GROUP BY 1
-  ORDER BY 1
-  ''',
-                           time=timeframe,
-                           grantee_name=grantee_name)
+    "wallets_chart": ('''
+    SELECT 
+    NAME,
+    DATE,
+    ACTIVE_WALLETS
+    FROM ARBIGRANTS.DBT.ARBIGRANTS_ALL_{time}_ACTIVE_WALLETS_BY_PROJECT
+    WHERE NAME IN (:names)
+    ORDER BY 2
+    ''', dict(time=timeframe, names=names)),
 
-  llama_bool = execute_sql('''
-  SELECT 
-  CASE WHEN LLAMA_NAME <> '' THEN 1
-  ELSE 0
-  END AS LLAMA_COUNT
-  FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA
-  WHERE LOWER(NAME) = LOWER('{grantee_name}')
-  ''',
-                           grantee_name=grantee_name)
+    "gas_chart": ('''
+    SELECT 
+    NAME,
+    DATE,
+    GAS_SPEND
+    FROM ARBIGRANTS.DBT.ARBIGRANTS_ALL_{time}_GAS_SPEND_BY_PROJECT
+    WHERE NAME IN (:names)
+    ORDER BY 2
+    ''', dict(time=timeframe, names=names)),
 
-  if llama_bool[0]["LLAMA_COUNT"] == 0:
-    tvl_chart = 0
-  else:
-    tvl_chart = execute_sql('''
+    "txns_chart": ('''
     SELECT 
+    c.NAME,
+    TO_VARCHAR(DATE_TRUNC('{time}',BLOCK_TIMESTAMP), 'YYYY-MM-DD') AS date,
+    COUNT(*) AS transactions
+    FROM ARBITRUM.RAW.TRANSACTIONS t
+    INNER JOIN ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_CONTRACTS c
+    ON c.CONTRACT_ADDRESS = t.TO_ADDRESS
+    AND t.BLOCK_TIMESTAMP < DATE_TRUNC('{time}',CURRENT_DATE())
+    AND t.BLOCK_TIMESTAMP >= to_timestamp('2023-06-01', 'yyyy-MM-dd')
+    AND c.NAME IN (:names)
+    GROUP BY 1, 2
+    ORDER BY 2
+    ''', dict(time=timeframe, names=names)),
+
+    "tvl_chart": ('''
+    SELECT 
+    NAME,
     DATE,
     TVL
     FROM ARBIGRANTS.DBT.ARBIGRANTS_ALL_{time}_TVL_BY_PROJECT
-    WHERE NAME = '{grantee_name}'
-    ORDER BY 1
-    ''',
-                            time=timeframe,
-                            grantee_name=grantee_name)
+    WHERE NAME IN (:names)
+    ORDER BY 2
+    ''', dict(time=timeframe, names=names)),
+
+    "milestones": ('''
+    SELECT NAME, MILESTONES_COMPLETED, TOTAL_MILESTONES
+    FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_MILESTONES
+    WHERE NAME IN (:names)
+    ''', dict(names=names)),
+  }
+  return {
+    name: query
+    for name, query in queries.items()
+    if name == "metadata" or name in sections
+  }
 
-  grant_date_bool = execute_sql('''
-  SELECT 
-  CASE WHEN GRANT_DATE <> '' THEN 1
-  ELSE 0
-  END AS GRANT_DATE_COUNT
-  FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA
-  WHERE LOWER(NAME) = LOWER('{grantee_name}')
-  ''',
-                                grantee_name=grantee_name)
 
-  if grant_date_bool[0]["GRANT_DATE_COUNT"] == 0:
-    grant_date = 0
-  else:
-    grant_date = execute_sql('''
-    SELECT GRANT_DATE
-    FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA
-    WHERE NAME = '{grantee_name}'
-    ''',
-                             grantee_name=grantee_name)
-
-  milestones = execute_sql('''
-  SELECT MILESTONES_COMPLETED, TOTAL_MILESTONES
-  FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_MILESTONES
-  WHERE NAME = '{grantee_name}'
-  ''',
-                           grantee_name=grantee_name)
+def split_by_name(rows):
+  grouped = {}
+  for row in rows:
+    grouped.setdefault(row["NAME"], []).append(
+      {k: v for k, v in row.items() if k != "NAME"})
+  return grouped
+
+
+def grantee_response(grantee_name, results):
+  # results are the outputs of grantee_queries, split by name
+
+  # the flags match the name case-insensitively while info and grant_date
+  # need an exact match, as the separate lookups used to
+  metadata = [
+    row for row in results["metadata"]
+    if row["NAME"].lower() == grantee_name.lower()
+  ]
+  # the name index turns most of these away, but not while it can't load
+  if not metadata:
+    abort(404, 'unknown grantee: %s' % grantee_name)
+  exact = [row for row in metadata if row["NAME"] == grantee_name]
+  info = [{
+    k: row[k]
+    for k in ("NAME", "LOGO", "DESCRIPTION", "WEBSITE", "TWITTER", "DUNE")
+  } for row in exact]
+  llama_bool = [{
+    "LLAMA_COUNT": 1 if row["LLAMA_NAME"] else 0
+  } for row in metadata]
+  grant_date_bool = [{
+    "GRANT_DATE_COUNT": 1 if row["GRANT_DATE"] else 0
+  } for row in metadata]
 
   response_data = {
     "info": info,
-    "wallets_chart": wallets_chart,
-    "gas_chart": gas_chart,
-    "txns_chart": txns_chart,
-    "tvl_chart": tvl_chart,
     "llama_bool": llama_bool,
     "grant_date_bool": grant_date_bool,
-    "grant_date": grant_date,
-    "milestones": milestones
   }
 
-  return jsonify(response_data)
+  if grant_date_bool[0]["GRANT_DATE_COUNT"] == 0:
+    response_data["grant_date"] = 0
+  else:
+    response_data["grant_date"] = [{
+      "GRANT_DATE": row["GRANT_DATE"]
+    } for row in exact]
 
+  for section in GRANTEE_SECTIONS:
+    if section in results:
+      response_data[section] = results[section].get(grantee_name, [])
+  if "tvl_chart" in response_data and llama_bool[0]["LLAMA_COUNT"] == 0:
+    response_data["tvl_chart"] = 0
 
-@app.route('/grantee-public')
-@cache.memoize(make_name=make_cache_key)
-def entitypublic():
-  grantee_name = request.args.get('grantee_name', 'pendle')
+  return response_data
 
-  info = execute_sql('''
+
+@app.route('/grantee')
+@swr_cached
+async def entity():
+  params = request_params()
+  timeframe = params['timeframe']
+  grantee_name = params['grantee_name']
+  since = parse_since(params['since'])
+  # the index lives in memory, so a misspelt name costs no warehouse work
+  known = await asyncio.to_thread(name_index.known, grantee_name)
+  if known is False:
+    abort(404, 'unknown grantee: %s' % grantee_name)
+
+  # tvl_chart is fetched alongside the metadata that decides whether it is
+  # used, so the whole set costs one round of queries. txns_chart scans the
+  # raw transactions.
+  results = await execute_many(grantee_queries(timeframe, [grantee_name],
+                                               GRANTEE_SECTIONS),
+                               heavy={"txns_chart"})
+  for section in GRANTEE_SECTIONS:
+    results[section] = split_by_name(results[section])
+
+  return series_delta(grantee_response(grantee_name, results), since,
+                      GRANTEE_CHARTS)
+
+
+def store_grantee_entries(timeframe, responses, version):
+  # a batch computes everything the single-grantee routes would, so it
+  # leaves their cache entries filled as well
+  for grantee_name, response_data in responses.items():
+    if response_data is None:
+      continue
+    public = {"info": response_data["info"]}
+    store_entry(route_cache_key('/grantee-public', grantee_name=grantee_name),
+                encode_payload(public), version)
+    if all(section in response_data for section in GRANTEE_SECTIONS):
+      store_entry(
+        route_cache_key('/grantee',
+                        timeframe=timeframe,
+                        grantee_name=grantee_name),
+        encode_payload(response_data), version)
+
+
+@app.route('/grantees')
+@swr_cached
+async def entities():
+  params = request_params()
+  timeframe = params['timeframe']
+  names = params['grantee_name']
+  sections = params['sections'] or GRANTEE_SECTIONS
+  if len(names) > GRANTEE_BATCH_MAX:
+    abort(400, 'at most %d grantee_name values' % GRANTEE_BATCH_MAX)
+  unknown = set(sections) - set(GRANTEE_SECTIONS)
+  if unknown:
+    abort(400, 'unknown sections: %s' % ', '.join(sorted(unknown)))
+  if not names:
+    return {}
+
+  version = await asyncio.to_thread(data_version)
+  queried = await asyncio.to_thread(
+    lambda: [name for name in names if name_index.known(name) is not False])
+  if not queried:
+    return {grantee_name: None for grantee_name in names}
+  results = await execute_many(grantee_queries(timeframe, queried, sections),
+                               heavy={"txns_chart"})
+  for section in sections:
+    results[section] = split_by_name(results[section])
+
+  # names without metadata are null rather than failing the whole batch
+  responses = {
+    grantee_name: grantee_response(grantee_name, results)
+    if any(row["NAME"].lower() == grantee_name.lower()
+           for row in results["metadata"]) else None
+    for grantee_name in names
+  }
+  await asyncio.to_thread(store_grantee_entries, timeframe, responses,
+                          version)
+  return responses
+
+
+@app.route('/grantee-public')
+@swr_cached
+async def entitypublic():
+  grantee_name = request_params()['grantee_name']
+  # a name the index doesn't hold can't have an exact match either
+  if await asyncio.to_thread(name_index.known, grantee_name) is False:
+    return {"info": []}
+
+  info = await execute_sql_async('''
   SELECT 
   NAME,
   LOGO,
@@ -669,13 +2387,76 @@ def entitypublic():
   TWITTER,
   DUNE
   FROM ARBIGRANTS.DBT.ARBIGRANTS_LABELS_PROJECT_METADATA
-  WHERE NAME = '{grantee_name}'
+  WHERE NAME = :grantee_name
   ''',
-                     grantee_name=grantee_name)
+                                 query_name='info',
+                                 grantee_name=grantee_name)
 
   response_data = {"info": info}
 
-  return jsonify(response_data)
+  return response_data
+
+
+@app.route('/data-version', methods=['POST'])
+def refresh_data_version():
+  # re-reads the version now instead of within DATA_VERSION_TTL; a change
+  # pre-warms the cache
+  if not DATA_VERSION_TOKEN:
+    abort(404)
+  expected = 'Bearer ' + DATA_VERSION_TOKEN
+  if not hmac.compare_digest(
+      request.headers.get('Authorization', '').encode('utf-8'),
+      expected.encode('utf-8')):
+    abort(401)
+  version = data_version(force=True)
+  if version is None:
+    abort(503)
+  return {"version": version.isoformat()}
+
+
+@app.route('/search')
+def search():
+  params = request_params()
+  try:
+    limit = min(int(params['limit']), SEARCH_LIMIT_MAX)
+  except ValueError:
+    abort(400, 'limit must be a number')
+  return {
+    "results": [{
+      "NAME": name
+    } for name in name_index.search(params['q'], limit)]
+  }
+
+
+@app.before_request
+def start_timer():
+  g.request_started = time.perf_counter()
+  g.deadline = time.monotonic() + REQUEST_DEADLINE
+
+
+@app.errorhandler(WarehouseUnavailable)
+def warehouse_unavailable(e):
+  # nothing cached and nothing the replica could answer
+  return {
+    "error": str(e)
+  }, 503, {
+    'Retry-After': str(int(BREAKER_COOLDOWN)),
+    'X-Degraded': 'warehouse-unavailable',
+  }
+
+
+@app.after_request
+def observe_request(response):
+  if 'request_started' in g and request.url_rule is not None:
+    REQUESTS.labels(request.url_rule.rule, response.status_code).observe(
+      time.perf_counter() - g.request_started)
+  return response
+
+
+@app.route('/metrics')
+def metrics():
+  body, content_type = exposition()
+  return app.response_class(body, headers={'Content-Type': content_type})
 
 
 if __name__ == '__main__':
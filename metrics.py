@@ -0,0 +1,97 @@
+import logging
+import os
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry,
+                               Counter, Histogram, REGISTRY, generate_latest,
+                               multiprocess)
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# Prometheus instrumentation for routes and warehouse queries. Queries are
+# labelled with the route that issued them and their name in the route's
+# query dict; background work (aggregate refreshes, the data version) has an
+# empty route. Query IDs are too many for a label, so they only appear in the
+# slow-query log.
+
+# queries slower than this many seconds are logged; 0 disables the log
+SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_SECONDS', '0'))
+
+QUERY_BUCKETS = (.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+QUERY_CONNECT = Histogram('arbigrants_query_connect_seconds',
+                          'Time waiting for a pooled Snowflake connection.',
+                          ['route', 'query'])
+QUERY_EXECUTE = Histogram('arbigrants_query_execute_seconds',
+                          'Time from submitting a statement to its results.',
+                          ['route', 'query'],
+                          buckets=QUERY_BUCKETS)
+QUERY_ROWS = Counter('arbigrants_query_rows', 'Rows returned by queries.',
+                     ['route', 'query'])
+QUERY_BYTES = Counter('arbigrants_query_bytes',
+                      'Approximate size of query results.',
+                      ['route', 'query'])
+FRAGMENT_LOOKUPS = Counter('arbigrants_fragment_cache_lookups',
+                           'Per-statement result cache lookups.',
+                           ['route', 'query', 'result'])
+ROUTE_CACHE = Counter('arbigrants_route_cache_lookups',
+                      'Route cache lookups by outcome: hit, stale, miss or '
+                      'not_modified.', ['route', 'result'])
+SERIALIZE = Histogram('arbigrants_serialize_seconds',
+                      'Time encoding and compressing a route payload.',
+                      ['route'])
+REQUESTS = Histogram('arbigrants_request_seconds',
+                     'Request latency as seen by the app.',
+                     ['route', 'status'],
+                     buckets=QUERY_BUCKETS)
+
+
+def observe_query(route, query, connect, execute, rows, size, query_id=None):
+  QUERY_CONNECT.labels(route, query).observe(connect)
+  QUERY_EXECUTE.labels(route, query).observe(execute)
+  QUERY_ROWS.labels(route, query).inc(rows)
+  QUERY_BYTES.labels(route, query).inc(size)
+  if SLOW_QUERY_SECONDS and connect + execute >= SLOW_QUERY_SECONDS:
+    logger.warning(
+      'slow query %s on %s: %.2fs connect, %.2fs execute, %d rows, '
+      '%d bytes, query id %s', query, route or '-', connect, execute, rows,
+      size, query_id)
+
+
+class StatsCollector:
+  # exposes the numeric values of a stats() dict as gauges, e.g. the
+  # connection pool's and the memory cache's metrics()
+
+  def __init__(self, prefix, documentation, stats):
+    self.prefix = prefix
+    self.documentation = documentation
+    self.stats = stats
+
+  def collect(self):
+    for name, value in sorted(self.stats().items()):
+      yield GaugeMetricFamily('%s_%s' % (self.prefix, name),
+                              self.documentation,
+                              value=value)
+
+
+# kept for the per-scrape registry of multiprocess mode
+stats_collectors = []
+
+
+def register_stats(prefix, documentation, stats):
+  collector = StatsCollector(prefix, documentation, stats)
+  stats_collectors.append(collector)
+  REGISTRY.register(collector)
+
+
+def exposition():
+  # (body, content type) for /metrics; with several worker processes set
+  # PROMETHEUS_MULTIPROC_DIR so the counters are summed across them. The
+  # stats gauges then describe the worker that answered the scrape.
+  if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    for collector in stats_collectors:
+      registry.register(collector)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+  return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
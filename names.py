@@ -0,0 +1,90 @@
+import bisect
+import difflib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# In-memory index of the grantee names, so routes can turn away unknown
+# names before any warehouse work and /search can autocomplete without a
+# query. Lookups are case-insensitive, as the grantee metadata match is.
+
+
+class NameIndex:
+  # load returns every project name. The index is rebuilt when version()
+  # changes or, while it can't be read, every refresh_interval seconds.
+
+  def __init__(self, load, version, refresh_interval):
+    self._load = load
+    self._version = version
+    self.refresh_interval = refresh_interval
+    self._lock = threading.Lock()
+    self._built = None
+    self._built_version = None
+    self._built_at = 0.0
+    self._failed_at = float('-inf')
+
+  def _fresh(self, version):
+    if self._built is None:
+      return False
+    if version is not None:
+      return version == self._built_version
+    return time.monotonic() - self._built_at < self.refresh_interval
+
+  def _index(self):
+    # (lower name -> names, sorted lower names), or None when the names
+    # have never loaded
+    version = self._version()
+    with self._lock:
+      if self._fresh(version):
+        return self._built
+      # after a failed load, wait refresh_interval before trying again
+      # rather than asking the warehouse on every request
+      if time.monotonic() - self._failed_at < self.refresh_interval:
+        return self._built
+    try:
+      names = self._load()
+    except Exception:
+      logger.exception('loading the grantee names failed')
+      with self._lock:
+        self._failed_at = time.monotonic()
+      return self._built
+
+    by_lower = {}
+    for name in names:
+      by_lower.setdefault(name.lower(), []).append(name)
+    built = (by_lower, sorted(by_lower))
+    with self._lock:
+      self._built = built
+      self._built_version = version
+      self._built_at = time.monotonic()
+    return built
+
+  def known(self, name):
+    # True or False, or None when the index isn't available and callers
+    # should ask the warehouse as before
+    index = self._index()
+    if index is None:
+      return None
+    return name.lower() in index[0]
+
+  def search(self, query, limit=10):
+    # names starting with query, then close misspellings of it
+    index = self._index()
+    if index is None or not query:
+      return []
+    by_lower, keys = index
+    query = query.lower()
+
+    matches = []
+    start = bisect.bisect_left(keys, query)
+    for key in keys[start:]:
+      if not key.startswith(query) or len(matches) >= limit:
+        break
+      matches.append(key)
+    if len(matches) < limit:
+      for key in difflib.get_close_matches(query, keys, n=limit, cutoff=0.6):
+        if key not in matches and len(matches) < limit:
+          matches.append(key)
+    return [name for key in matches for name in sorted(by_lower[key])][:limit]
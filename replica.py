@@ -0,0 +1,218 @@
+import fcntl
+import logging
+import os
+import re
+import threading
+import time
+
+import duckdb
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+# Parquet snapshots of the small dbt tables, queried in process with DuckDB.
+# A statement is answered locally only when every table it names is in the
+# replica, so anything reading raw transactions or DefiLlama still goes to
+# Snowflake.
+
+TABLE_REF = re.compile(r'\b(\w+)\.(\w+)\.(\w+)\b')
+
+# Snowflake spellings DuckDB doesn't accept
+REWRITES = [
+  (re.compile(r'\bCURRENT_DATE\(\)', re.I), 'CURRENT_DATE'),
+  (re.compile(r"\bto_timestamp\(('[^']*'|\?),\s*'yyyy-MM-dd'\)",
+              re.I), r'CAST(\1 AS TIMESTAMP)'),
+]
+TO_VARCHAR = re.compile(r'\bTO_VARCHAR\(', re.I)
+# Snowflake date format elements and their strftime equivalents
+DATE_FORMAT = [('YYYY', '%Y'), ('MM', '%m'), ('DD', '%d'), ('HH24', '%H'),
+               ('MI', '%M'), ('SS', '%S')]
+
+
+def rewrite_to_varchar(sql):
+  # TO_VARCHAR(expr, 'format') -> strftime(expr, '...') and TO_VARCHAR(expr)
+  # -> CAST(expr AS VARCHAR); expr may hold its own parentheses and commas
+  match = TO_VARCHAR.search(sql)
+  while match:
+    depth, comma, end = 1, None, match.end()
+    while depth:
+      if end == len(sql):
+        # unbalanced; DuckDB rejects it either way
+        return sql
+      char = sql[end]
+      if char == '(':
+        depth += 1
+      elif char == ')':
+        depth -= 1
+      elif char == ',' and depth == 1:
+        comma = end
+      end += 1
+    if comma is None:
+      local = 'CAST(%s AS VARCHAR)' % sql[match.end():end - 1]
+    else:
+      fmt = sql[comma + 1:end - 1].strip()
+      for element, directive in DATE_FORMAT:
+        fmt = fmt.replace(element, directive)
+      local = 'strftime(%s, %s)' % (sql[match.end():comma], fmt)
+    sql = sql[:match.start()] + local + sql[end:]
+    match = TO_VARCHAR.search(sql, match.start() + len(local))
+  return sql
+
+
+class Replica:
+  # query returns a statement's result as an Arrow table. Snapshots are
+  # rewritten in the background once older than refresh_interval, by one
+  # process per host, and only served while younger than max_age unless the
+  # caller says stale data will do. changed_at, when given, returns the
+  # time the source data last changed; older snapshots are resynced and not
+  # served fresh either.
+
+  def __init__(self,
+               query,
+               tables,
+               directory,
+               refresh_interval,
+               max_age,
+               changed_at=None):
+    self._query = query
+    self.tables = set(table.upper() for table in tables)
+    self.directory = directory
+    self.refresh_interval = refresh_interval
+    self.max_age = max_age
+    self._changed_at = changed_at
+    self._db = duckdb.connect()
+    self._local = threading.local()
+    self._views = set()
+    self._lock = threading.Lock()
+    self._syncing = False
+    self._sync_started = 0.0
+
+  def _path(self, table):
+    return os.path.join(self.directory, table + '.parquet')
+
+  def _cursor(self):
+    # DuckDB connections aren't shared between threads; cursors are cheap
+    # duplicates of the same database
+    cursor = getattr(self._local, 'cursor', None)
+    if cursor is None:
+      with self._lock:
+        cursor = self._local.cursor = self._db.cursor()
+    return cursor
+
+  def _ensure_view(self, table):
+    if table in self._views:
+      return
+    with self._lock:
+      self._db.execute(
+        'CREATE OR REPLACE VIEW "%s" AS SELECT * FROM read_parquet(\'%s\')' %
+        (table, self._path(table)))
+      self._views.add(table)
+
+  def translate(self, sql):
+    # (DuckDB statement, tables read) or None if sql reads anything the
+    # replica doesn't hold
+    tables = set()
+    for database, schema, table in TABLE_REF.findall(sql):
+      if (database.upper(), schema.upper()) != ('ARBIGRANTS', 'DBT'):
+        return None
+      if table.upper() not in self.tables:
+        return None
+      tables.add(table.upper())
+    if not tables:
+      return None
+    local = TABLE_REF.sub(lambda match: '"%s"' % match.group(3).upper(), sql)
+    for pattern, replacement in REWRITES:
+      local = pattern.sub(replacement, local)
+    return rewrite_to_varchar(local), tables
+
+  def age(self, tables):
+    try:
+      oldest = min(os.path.getmtime(self._path(table)) for table in tables)
+    except OSError:
+      return float('inf')
+    return time.time() - oldest
+
+  def query(self, sql, params=None, stale=False, arrow=False):
+    # rows as a DictCursor returns them, or an Arrow table with arrow, or
+    # None when the replica can't answer: a table is missing or too old, or
+    # DuckDB rejects the statement. params are bound to the statement's ?
+    # placeholders.
+    translated = self.translate(sql)
+    if translated is None:
+      return None
+    local, tables = translated
+    age = self.age(tables)
+    changed = self._changed_at() if self._changed_at else None
+    outdated = changed is not None and time.time() - age < changed
+    if age > self.refresh_interval or outdated:
+      self._sync_in_background(changed)
+    if age == float('inf') or ((age > self.max_age or outdated) and not stale):
+      return None
+
+    for table in tables:
+      self._ensure_view(table)
+    cursor = self._cursor()
+    try:
+      cursor.execute(local, params or None)
+      # Snowflake upper-cases unquoted identifiers, DuckDB keeps them as typed
+      columns = [column[0].upper() for column in cursor.description]
+      if arrow:
+        return cursor.fetch_arrow_table().rename_columns(columns)
+      return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    except duckdb.Error as e:
+      # a Snowflake construct translate() doesn't cover; the warehouse
+      # answers it as before
+      logger.debug('replica could not run statement on %s: %s',
+                   ', '.join(sorted(tables)), e)
+      return None
+
+  def _sync_in_background(self, changed=None):
+    with self._lock:
+      # a failed sync is retried after refresh_interval, not on every query,
+      # unless the data changed since it started
+      recent = time.time() - self._sync_started < self.refresh_interval
+      if self._syncing or (recent and
+                           not (changed and self._sync_started < changed)):
+        return
+      self._syncing = True
+      self._sync_started = time.time()
+
+    def run():
+      try:
+        self.sync()
+      except Exception:
+        logger.exception('syncing the replica failed')
+      finally:
+        with self._lock:
+          self._syncing = False
+
+    threading.Thread(target=run, daemon=True).start()
+
+  def sync(self):
+    # snapshot every table; returns how many were written, or None when
+    # another process on this host is already syncing
+    os.makedirs(self.directory, exist_ok=True)
+    with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+      try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        return None
+      written = 0
+      for table in sorted(self.tables):
+        try:
+          data = self._query('SELECT * FROM ARBIGRANTS.DBT.%s' % table)
+        except Exception:
+          # an unavailable warehouse fails every table the same way; the
+          # rest keep their current snapshots until the next sync
+          logger.exception('snapshotting %s failed', table)
+          break
+        if data is None:
+          # an empty result has no schema to write; the table stays with the
+          # warehouse
+          continue
+        path = self._path(table)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        pq.write_table(data, tmp)
+        os.replace(tmp, path)
+        written += 1
+      return written
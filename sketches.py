@@ -0,0 +1,158 @@
+import os
+import threading
+from datetime import date
+
+import numpy as np
+
+from aggregates import day_column, name_column, number_column
+
+# HyperLogLog sketches of active wallets per project and day. Registers are
+# computed in the warehouse from HASH(FROM_ADDRESS) and kept sparse, so the
+# distinct wallet count of any union of projects and days is an elementwise
+# max over registers plus the HLL estimator, with no raw transaction scan.
+#
+# With 2^12 registers the relative standard error is 1.04 / sqrt(4096),
+# about 1.6%; roughly 95% of estimates land within 3.3% of the exact count.
+
+PRECISION = 12
+REGISTERS = 1 << PRECISION
+# bits of the hash left after the register index that feed the rank
+RANK_BITS = 40
+
+
+def registers_sql(hashed_sql):
+  # hashed_sql selects NAME, DATE and H = HASH(wallet); the result has one
+  # row per non-empty register of each (NAME, DATE) sketch
+  return '''
+  WITH hashed AS (
+  %s
+  ),
+  split AS (
+  SELECT NAME, DATE,
+  BITAND(H, %d) AS IDX,
+  BITAND(BITSHIFTRIGHT(H, %d), %d) AS W
+  FROM hashed
+  )
+  SELECT NAME, DATE, IDX,
+  MAX(CASE WHEN W = 0 THEN %d ELSE %d - FLOOR(LOG(2, W)) END) AS RANK
+  FROM split
+  GROUP BY 1, 2, 3
+  ''' % (hashed_sql, REGISTERS - 1, PRECISION, (1 << RANK_BITS) - 1,
+         RANK_BITS + 1, RANK_BITS)
+
+
+def estimate(registers):
+  # standard HLL estimator with the small-range (linear counting)
+  # correction; registers is (..., REGISTERS)
+  registers = np.asarray(registers, dtype=float)
+  alpha = 0.7213 / (1 + 1.079 / REGISTERS)
+  raw = alpha * REGISTERS * REGISTERS / np.sum(2.0**-registers, axis=-1)
+  zeros = np.sum(registers == 0, axis=-1)
+  linear = REGISTERS * np.log(REGISTERS / np.maximum(zeros, 1))
+  return np.where((raw <= 2.5 * REGISTERS) & (zeros > 0), linear, raw)
+
+
+def bucket_start(days, timeframe):
+  # days is datetime64[D]; mirrors DATE_TRUNC with Monday-based weeks
+  if timeframe == 'month':
+    return days.astype('datetime64[M]').astype('datetime64[D]')
+  if timeframe == 'week':
+    # 1970-01-01 was a Thursday
+    return days - (days.astype(int) + 3) % 7
+  return days
+
+
+class SketchFrame:
+  # one entry per non-empty register: which project, which day, which
+  # register and its rank
+
+  def __init__(self, names, name_idx, days, idx, rank):
+    self.names = names
+    self.name_idx = name_idx
+    self.days = days
+    self.idx = idx
+    self.rank = rank
+
+  @classmethod
+  def from_arrow(cls, table, metrics=None):
+    if table is None or table.num_rows == 0:
+      return cls(np.array([], dtype=object), np.array([], dtype=np.int32),
+                 np.array([], dtype='datetime64[D]'),
+                 np.array([], dtype=np.uint16), np.array([], dtype=np.uint8))
+    names, name_idx = np.unique(name_column(table), return_inverse=True)
+    return cls(names, name_idx.astype(np.int32),
+               day_column(table)[0],
+               number_column(table, 'IDX', np.uint16),
+               number_column(table, 'RANK', np.uint8))
+
+  def merge(self, newer, since):
+    keep = self.days < np.datetime64(since, 'D')
+    names = np.array(sorted(set(self.names) | set(newer.names)), dtype=object)
+    old_map = np.searchsorted(names, self.names).astype(np.int32)
+    new_map = np.searchsorted(names, newer.names).astype(np.int32)
+    return SketchFrame(
+      names,
+      np.concatenate([old_map[self.name_idx[keep]],
+                      new_map[newer.name_idx]]),
+      np.concatenate([self.days[keep], newer.days]),
+      np.concatenate([self.idx[keep], newer.idx]),
+      np.concatenate([self.rank[keep], newer.rank]))
+
+  def save(self, path):
+    tmp = '%s.%d.%d.tmp.npz' % (path, os.getpid(), threading.get_ident())
+    np.savez(tmp,
+             names=self.names.astype(str),
+             name_idx=self.name_idx,
+             days=self.days,
+             idx=self.idx,
+             rank=self.rank)
+    os.replace(tmp, path)
+
+  @classmethod
+  def load(cls, path):
+    with np.load(path) as data:
+      return cls(data["names"].astype(object), data["name_idx"], data["days"],
+                 data["idx"], data["rank"])
+
+  def last_date(self):
+    return self.days.max().astype(date) if len(self.days) else None
+
+  def _entries(self, excludes, start, end, floors=None):
+    included = ~np.isin(self.names, list(excludes))
+    mask = included[self.name_idx]
+    if start is not None:
+      mask &= self.days >= np.datetime64(start, 'D')
+    if end is not None:
+      mask &= self.days < np.datetime64(end, 'D')
+    if floors:
+      # per-project first day to count, e.g. its grant date
+      first = np.array([floors.get(name, date.min) for name in self.names],
+                       dtype='datetime64[D]')
+      mask &= self.days >= first[self.name_idx]
+    return mask
+
+  def distinct(self, excludes=(), start=None, end=None):
+    mask = self._entries(excludes, start, end)
+    registers = np.zeros(REGISTERS, dtype=np.uint8)
+    np.maximum.at(registers, self.idx[mask], self.rank[mask])
+    return float(estimate(registers))
+
+  def distinct_by_name(self, excludes=(), start=None, end=None):
+    # (names, estimates) for every included project active in the window
+    mask = self._entries(excludes, start, end)
+    registers = np.zeros((len(self.names), REGISTERS), dtype=np.uint8)
+    np.maximum.at(registers, (self.name_idx[mask], self.idx[mask]),
+                  self.rank[mask])
+    active = registers.any(axis=1)
+    return self.names[active], estimate(registers[active])
+
+  def distinct_by_period(self, timeframe, excludes=(), start=None, end=None,
+                         floors=None):
+    # (period starts, estimates) of the union of included projects per
+    # DATE_TRUNC(timeframe) bucket
+    mask = self._entries(excludes, start, end, floors)
+    buckets = bucket_start(self.days[mask], timeframe)
+    periods, bucket_idx = np.unique(buckets, return_inverse=True)
+    registers = np.zeros((len(periods), REGISTERS), dtype=np.uint8)
+    np.maximum.at(registers, (bucket_idx, self.idx[mask]), self.rank[mask])
+    return periods, estimate(registers)